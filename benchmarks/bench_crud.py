@@ -0,0 +1,180 @@
+""" Throughput and latency of the Table CRUD hot paths
+
+Runs every benchmark against an in memory and a file backed database built
+from tests/test_tables.sql and writes the results as JSON so runs can be
+compared across commits.
+
+    python3 benchmarks/bench_crud.py --rows 2000 --out bench.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from danql import Database, Table, close_all, schema_cache
+
+import datagen
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', 'tests', 'test_tables.sql')
+
+
+class Breed(Table):
+    def __init__(self, db_file=None):
+        super().__init__(table_name='breed', db_file=db_file)
+
+
+class Owner(Table):
+    def __init__(self, db_file=None):
+        super().__init__(table_name='owner', db_file=db_file)
+
+
+class Dog(Table):
+    def __init__(self, db_file=None):
+        super().__init__(table_name='dog', db_file=db_file)
+
+
+def percentile(sorted_values, pct):
+    if len(sorted_values) == 0:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def timed(op, db, calls):
+    # Run every zero argument callable in calls, return one result dict
+    latencies = []
+    start = time.perf_counter()
+    for call in calls:
+        t0 = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'db': db,
+        'op': op,
+        'n': len(latencies),
+        'seconds': elapsed,
+        'ops_per_sec': len(latencies) / elapsed if elapsed > 0 else None,
+        'p50_us': percentile(latencies, 50) * 1e6 if latencies else None,
+        'p99_us': percentile(latencies, 99) * 1e6 if latencies else None,
+    }
+
+
+def run(db_label, db_file, args):
+    rng = datagen.seeded(args.seed)
+    with Database(db_file) as db:
+        db.from_sqlfile(SCHEMA)
+    results = []
+
+    results.append(timed('table_construction', db_label, [
+        lambda: Dog(db_file) for _ in range(args.rows // 10 or 1)]))
+    breed, owner, dog = Breed(db_file), Owner(db_file), Dog(db_file)
+
+    breed_rows = datagen.breeds(rng, args.rows, args.width, args.duplicate_ratio)
+    results.append(timed('create_record', db_label, [
+        (lambda row=row: breed.create_record(**row)) for row in breed_rows]))
+
+    owner_rows = datagen.owners(rng, args.rows, args.width)
+    start = time.perf_counter()
+    owner_ids = owner.create_records(owner_rows)
+    elapsed = time.perf_counter() - start
+    results.append({
+        'db': db_label, 'op': 'create_records', 'n': len(owner_rows),
+        'seconds': elapsed, 'ops_per_sec': len(owner_rows) / elapsed if elapsed > 0 else None,
+        'p50_us': None, 'p99_us': None,
+    })
+
+    breed_ids = [r['breed_id'] for r in breed.read_record()]
+    dog_rows = datagen.dogs(rng, args.rows, breed_ids, owner_ids, args.width, args.duplicate_ratio)
+    results.append(timed('create_record_composite', db_label, [
+        (lambda row=row: dog.create_record(**row)) for row in dog_rows]))
+
+    lookups = [rng.choice(breed_ids) for _ in range(args.rows)]
+    results.append(timed('read_record_pk', db_label, [
+        (lambda pk=pk: breed.read_record(breed_id=pk)) for pk in lookups]))
+    lookup_names = [rng.choice(breed_rows)['name'] for _ in range(args.rows)]
+    results.append(timed('read_record_indexed', db_label, [
+        (lambda name=name: breed.read_record(name=name)) for name in lookup_names]))
+    lookup_owners = [rng.choice(owner_ids) for _ in range(args.rows // 10 or 1)]
+    results.append(timed('count_where', db_label, [
+        (lambda pk=pk: dog.count_where(owner_id=pk)) for pk in lookup_owners]))
+
+    to_update = [breed.read_record(breed_id=pk) for pk in breed_ids[:args.rows // 2]]
+    results.append(timed('update_record', db_label, [
+        (lambda rows=rows, n=n: breed.update_record(rows=rows, name=f'updated-{n}'))
+        for n, rows in enumerate(to_update)]))
+
+    to_delete = [breed.read_record(breed_id=pk) for pk in breed_ids[args.rows // 2:]]
+    results.append(timed('delete_record', db_label, [
+        (lambda rows=rows: breed.delete_record(rows=rows)) for rows in to_delete]))
+    return results
+
+
+def git_commit():
+    try:
+        out = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--width', type=int, default=16, help='characters per TEXT value')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', choices=['memory', 'file', 'both'], default='both')
+    parser.add_argument('--profile', default=None, help='connection profile, see danql.PROFILES')
+    parser.add_argument('--out', default=None, help='JSON file, stdout if not given')
+    args = parser.parse_args(argv)
+    if args.profile is not None:
+        os.environ['DANQL_PROFILE'] = args.profile
+
+    results = []
+    if args.db in ('memory', 'both'):
+        results.extend(run('memory', ':memory:', args))
+    if args.db in ('file', 'both'):
+        tmp = tempfile.mkdtemp()
+        try:
+            results.extend(run('file', os.path.join(tmp, 'bench.db'), args))
+        finally:
+            close_all()
+            schema_cache.invalidate()
+            shutil.rmtree(tmp)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'rows': args.rows,
+            'width': args.width,
+            'duplicate_ratio': args.duplicate_ratio,
+            'seed': args.seed,
+            'profile': os.getenv('DANQL_PROFILE', 'default'),
+        },
+        'results': results,
+    }
+    if args.out is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import random
+import string
+
+# Synthetic rows for the dog/owner/breed schema in tests/test_tables.sql
+
+
+def random_text(rng, width):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(width))
+
+
+def unique_text(rng, n, width):
+    # About width characters, unique through the n prefix
+    prefix = f'{n}-'
+    return prefix + random_text(rng, max(0, width - len(prefix)))
+
+
+def names(rng, rows, width=16, duplicate_ratio=0.0):
+    # rows names of width characters where about duplicate_ratio of them
+    # repeat a name generated earlier, the first one is always unique
+    out = []
+    for n in range(rows):
+        if n > 0 and rng.random() < duplicate_ratio:
+            out.append(rng.choice(out))
+        else:
+            out.append(unique_text(rng, n, width))
+    return out
+
+
+def breeds(rng, rows, width=16, duplicate_ratio=0.0):
+    return [dict(name=name) for name in names(rng, rows, width, duplicate_ratio)]
+
+
+def owners(rng, rows, width=16):
+    return [dict(name=name) for name in names(rng, rows, width)]
+
+
+def dogs(rng, rows, breed_ids, owner_ids, width=16, duplicate_ratio=0.0):
+    # Every (breed_id, owner_id, name) is the primary key, duplicates repeat
+    # an earlier one outright
+    out = []
+    for n in range(rows):
+        if n > 0 and rng.random() < duplicate_ratio:
+            out.append(dict(rng.choice(out)))
+        else:
+            out.append(dict(
+                breed_id=rng.choice(breed_ids),
+                owner_id=rng.choice(owner_ids),
+                name=unique_text(rng, n, width),
+            ))
+    return out
+
+
+def seeded(seed=0):
+    return random.Random(seed)
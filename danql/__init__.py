@@ -1,2 +1,13 @@
 from .database import Database
-from .table import Table
+from .table import Page, Table
+from .pool import PROFILES, ConnectionPool, close_all, get_pool
+from .schema import SchemaCache, schema_cache
+from .cache import RowCache, RowCount
+from .instrument import SlowQueryLog, StatementStats, instrumentation
+from .advisor import IndexAdvisor
+from .record import Record
+from .writer import WriteQueue, get_write_queue
+from .backup import BackupSchedule, backup
+from .queries import QueryRegistry, get_query_registry
+from .transaction import Transaction
+from .aio import AsyncDatabase, AsyncTable
@@ -0,0 +1,108 @@
+import re
+import threading
+
+from .table import compile_statement
+
+# sqlite assumes about this many rows match an equality on an index it
+# has no ANALYZE statistics for, used to estimate partial index cost
+ROWS_PER_INDEX_KEY = 10
+
+_index_columns = re.compile(r'\((.*)\)\s*$')
+
+
+class IndexAdvisor:
+    """ Suggest indexes from the filters read_record and count_where see
+
+    Attach one to any number of tables (Table(..., index_advisor=advisor)
+    or table.index_advisor = advisor) and it counts every combination of
+    equality filter columns they are called with. report() runs EXPLAIN
+    QUERY PLAN for each combination and ranks the ones sqlite answers with
+    a full table SCAN, or with an index that covers only some of the
+    columns, by estimated rows visited:
+
+        SCAN                      calls * rows in table
+        SEARCH on part of them    calls * ROWS_PER_INDEX_KEY
+
+    ddl() turns the report into CREATE INDEX statements, most selective
+    column first.
+    """
+
+    def __init__(self):
+        self.filters = {}  # (table_name, columns) -> calls
+        self.tables = {}  # table_name -> Table
+        self._lock = threading.Lock()
+
+    def record(self, table, columns):
+        if len(columns) == 0:
+            return
+        key = (table.table_name, tuple(sorted(columns)))
+        with self._lock:
+            self.filters[key] = self.filters.get(key, 0) + 1
+            self.tables.setdefault(table.table_name, table)
+
+    def report(self):
+        # Returns List[dict] of table, columns, calls, plan, rows, cost
+        # and ddl for filters that aren't fully indexed, highest cost first
+        with self._lock:
+            filters = dict(self.filters)
+        suggestions = []
+        for (table_name, columns), calls in filters.items():
+            table = self.tables[table_name]
+            with table.database() as db:
+                sql = compile_statement('select', table_name, columns)
+                plan = [row[3] for row in db.query(f"EXPLAIN QUERY PLAN {sql}", [None] * len(columns))]
+                used = self.columns_used(plan, table_name)
+                if used is not None and 'rowid' in used:
+                    # INTEGER PRIMARY KEY is the rowid
+                    used |= set(table.primary_keys)
+                if used is not None and set(columns) <= used:
+                    continue
+                rows = db.query(f"SELECT count(*) FROM {table_name}")[0][0]
+                if used is None:
+                    cost = calls * rows
+                else:
+                    cost = calls * min(rows, ROWS_PER_INDEX_KEY)
+                ordered = self.by_selectivity(db, table_name, columns)
+            suggestions.append({
+                'table': table_name,
+                'columns': ordered,
+                'calls': calls,
+                'plan': plan,
+                'rows': rows,
+                'cost': cost,
+                'ddl': self.create_index(table_name, ordered),
+            })
+        suggestions.sort(key=lambda s: (s['cost'], s['calls']), reverse=True)
+        return suggestions
+
+    def ddl(self):
+        return [s['ddl'] for s in self.report()]
+
+    @staticmethod
+    def columns_used(plan, table_name):
+        # Columns the plan searches table_name by, None if it scans it
+        # sqlite < 3.36 writes SCAN TABLE t / SEARCH TABLE t
+        step = re.compile(rf'(SCAN|SEARCH) (?:TABLE )?{re.escape(table_name)}\b', re.IGNORECASE)
+        for line in plan:
+            match = step.match(line)
+            if match is None:
+                continue
+            if match.group(1).upper() == 'SCAN':
+                return None
+            match = _index_columns.search(line)
+            if match is None:
+                return set()
+            terms = match.group(1).split(' AND ')
+            return set(re.split(r'[=<>]', term)[0].strip() for term in terms)
+        return None
+
+    @staticmethod
+    def by_selectivity(db, table_name, columns):
+        distinct = ','.join(f'count(DISTINCT {col})' for col in columns)
+        counts = db.query(f"SELECT {distinct} FROM {table_name}")[0]
+        return [col for _, col in sorted(zip(counts, columns), key=lambda c: -c[0])]
+
+    @staticmethod
+    def create_index(table_name, columns):
+        name = '_'.join(['idx', table_name] + list(columns))
+        return f"CREATE INDEX IF NOT EXISTS {name} ON {table_name} ({', '.join(columns)});"
@@ -0,0 +1,242 @@
+import asyncio
+import functools
+import itertools
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from .database import Database
+
+DEFAULT_READERS = int(os.getenv('DANQL_ASYNC_READERS', 4))
+
+_read_statements = ('SELECT', 'VALUES', 'EXPLAIN')
+_string_literal = re.compile(r"'(?:[^']|'')*'")
+_writes = re.compile(r'\b(INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+_pragma = re.compile(r'PRAGMA\s+(?:\w+\.)?(\w+)\s*([(=])?', re.IGNORECASE)
+# PRAGMAs that change something even without a value
+_acting_pragmas = {'optimize', 'wal_checkpoint', 'incremental_vacuum', 'shrink_memory'}
+# PRAGMAs whose (argument) is what to read rather than a value to set
+_reading_pragmas = {
+    'table_info', 'table_xinfo', 'index_list', 'index_info', 'index_xinfo',
+    'foreign_key_list', 'foreign_key_check', 'integrity_check', 'quick_check',
+}
+
+
+def is_read(sql):
+    # True for statements that can't write, which may go to a reader thread
+    statement = sql.lstrip().upper()
+    if statement.startswith(_read_statements):
+        return True
+    if statement.startswith('WITH'):
+        # WITH ... SELECT, unless the CTE feeds an INSERT/UPDATE/DELETE
+        return _writes.search(_string_literal.sub("''", sql)) is None
+    match = _pragma.match(sql.lstrip())
+    if match is not None:
+        name, argument = match.group(1).lower(), match.group(2)
+        if argument == '=' or name in _acting_pragmas:
+            return False
+        return argument is None or name in _reading_pragmas
+    return False
+
+
+class AsyncDatabase:
+    """ Runs danql calls on threads so they don't block the event loop
+
+    Writes go to a single writer thread. Reads go to up to `readers`
+    reader threads when the database is in WAL mode (e.g. the 'throughput'
+    profile), where readers don't wait for the writer. Otherwise everything
+    runs on the writer thread, which is also the only thread that sees an
+    in memory database. Each thread keeps its own pooled connection, so
+    the pool's max_size should be at least 2 * readers + 1.
+
+    Cancelling a coroutine that is already running its sql interrupts the
+    statement with Connection.interrupt(). Its transaction is rolled back.
+
+    Async iterators fetch one batch per executor job. Other calls can run
+    between batches, so awaiting writes inside `async for` is fine. In WAL
+    mode iterators run on `readers` stream threads of their own, each
+    iterator pinned to one of them in turn so its cursor stays on one
+    connection without holding up the shared readers.
+
+        async with AsyncDatabase(db_file, profile='throughput') as adb:
+            rows = await adb.query("SELECT * FROM dog WHERE owner_id = ?", (1,))
+            dogs = AsyncTable(adb, Table('dog', db_file=db_file, profile='throughput'))
+            await dogs.create_record(name='fido', owner_id=1)
+            async for dog in dogs.iter_records(owner_id=1):
+                ...
+    """
+
+    def __init__(self, db_file=None, profile=None, readers=DEFAULT_READERS):
+        db = Database(db_file, profile=profile)
+        self.db_file = db_file
+        self.profile = db.pool.profile
+        self.pool = db.pool
+        self.wal = db.query("PRAGMA journal_mode")[0][0].lower() == 'wal'
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='danql-writer')
+        if self.wal and readers > 0:
+            self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='danql-reader')
+            self.streams = [
+                ThreadPoolExecutor(max_workers=1, thread_name_prefix='danql-stream')
+                for _ in range(readers)
+            ]
+        else:
+            self.readers = self.writer
+            self.streams = [self.writer]
+        self._next_stream = itertools.cycle(self.streams)
+
+    def database(self):
+        # Database for the calling executor thread
+        return Database(self.db_file, profile=self.profile)
+
+    async def run(self, func, *args, write=True, **kwargs):
+        # Await func(*args, **kwargs) on the writer (or a reader) thread
+        executor = self.writer if write else self.readers
+        return await self._run(executor, func, args, kwargs)
+
+    async def _run(self, executor, func, args, kwargs):
+        # The connection to interrupt is this pool's connection for the
+        # executor thread, AsyncTable makes sure tables use this pool
+        state = {'conn': None}
+        pool = self.pool
+
+        def call():
+            state['conn'] = pool.connection()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                state['conn'] = None
+
+        future = executor.submit(call)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # A call that hasn't started yet just never runs
+            if not future.cancel() and state['conn'] is not None:
+                state['conn'].interrupt()
+            raise
+
+    async def stream(self, iterable_factory, batch_size=1000, write=False):
+        # Async iterator over iterable_factory(), created and advanced on
+        # one thread one batch_size batch per job
+        executor = self.writer if write else next(self._next_stream)
+        state = {'rows': None}
+
+        def fetch():
+            if state['rows'] is None:
+                state['rows'] = iter(iterable_factory())
+            return list(itertools.islice(state['rows'], batch_size))
+
+        def close():
+            close_rows = getattr(state['rows'], 'close', None)
+            if close_rows is not None:
+                close_rows()
+
+        try:
+            while True:
+                batch = await self._run(executor, fetch, (), {})
+                for row in batch:
+                    yield row
+                if len(batch) < batch_size:
+                    break
+        finally:
+            # Closes the cursor, releasing its read lock, on the thread
+            # that opened it
+            executor.submit(close)
+
+    async def query(self, sql, params=(), **options):
+        # Database.query, options are columnar, types and record_class
+        return await self.run(self._query, sql, params, write=not is_read(sql), **options)
+
+    def _query(self, sql, params, **options):
+        with self.database() as db:
+            return db.query(sql, params, **options)
+
+    def iter_query(self, sql, params=(), batch_size=1000, record_class=None):
+        def rows():
+            # cursor stays on this thread's connection until exhausted
+            yield from self.database().iter_query(
+                sql, params, batch_size=batch_size, record_class=record_class)
+        return self.stream(rows, batch_size=batch_size, write=not is_read(sql))
+
+    async def insert(self, sql, params=()):
+        return await self.run(self._insert, 'insert', sql, params)
+
+    async def insert_many(self, sql, seq_of_params):
+        return await self.run(self._insert, 'insert_many', sql, seq_of_params)
+
+    def _insert(self, method, sql, params):
+        with self.database() as db:
+            return getattr(db, method)(sql, params)
+
+    async def close(self, wait=True):
+        loop = asyncio.get_running_loop()
+        executors = [self.writer]
+        if self.readers is not self.writer:
+            executors += [self.readers] + self.streams
+        for executor in executors:
+            await loop.run_in_executor(None, functools.partial(executor.shutdown, wait=wait))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, ext_type, exc_value, traceback):
+        await self.close()
+
+
+class AsyncTable:
+    """ Coroutine versions of a Table's methods, run on an AsyncDatabase
+
+    Writes run on its writer thread and reads on its reader threads.
+    iter_records is an async iterator.
+    """
+
+    def __init__(self, database, table):
+        # The table has to run on database's pool for the writer/reader
+        # split and cancellation to apply to it
+        if table.database().pool is not database.pool:
+            raise ValueError(
+                f'{table.table_name} is not on the AsyncDatabase\'s db_file and profile')
+        self.database = database
+        self.table = table
+
+    async def create_record(self, **kwargs):
+        return await self.database.run(self.table.create_record, **kwargs)
+
+    async def create_records(self, rows, **options):
+        return await self.database.run(self.table.create_records, rows, **options)
+
+    async def read_record(self, **kwargs):
+        return await self.database.run(self.table.read_record, write=False, **kwargs)
+
+    def iter_records(self, batch_size=1000, not_equal=False, as_records=False, **kwargs):
+        return self.database.stream(
+            functools.partial(
+                self.table.iter_records, batch_size=batch_size, not_equal=not_equal,
+                as_records=as_records, **kwargs),
+            batch_size=batch_size)
+
+    async def update_record(self, rows, not_equal=False, **kwargs):
+        return await self.database.run(
+            self.table.update_record, rows, not_equal=not_equal, **kwargs)
+
+    async def delete_record(self, rows):
+        return await self.database.run(self.table.delete_record, rows)
+
+    async def total_rows(self):
+        return await self.database.run(self.table.total_rows, write=False)
+
+    async def count_where(self, not_equal=False, **kwargs):
+        return await self.database.run(
+            self.table.count_where, write=False, not_equal=not_equal, **kwargs)
+
+    async def aggregate(self, **kwargs):
+        return await self.database.run(self.table.aggregate, write=False, **kwargs)
+
+    async def named_query(self, name, params=(), columnar=False):
+        sql = self.table.queries.sql(name) if self.table.queries is not None else ''
+        return await self.database.run(
+            self.table.named_query, name, params, write=not is_read(sql), columnar=columnar)
+
+    async def raw_query(self, sql, columnar=False):
+        return await self.database.run(
+            self.table.raw_query, sql, write=not is_read(sql), columnar=columnar)
@@ -0,0 +1,105 @@
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import closing
+
+from .database import Database
+
+DEFAULT_PAGES = 1024  # pages copied per step
+DEFAULT_SLEEP = 0.01  # seconds between steps
+
+
+def backup(db_file, target, pages=DEFAULT_PAGES, sleep=DEFAULT_SLEEP, progress=None,
+           check=True, profile=None):
+    """ Copy db_file to target while it stays in use
+
+    Uses the sqlite online backup API (sqlite3.Connection.backup) which
+    copies pages at a time and sleeps in between, so writers only wait for
+    a single step instead of the whole copy. pages=-1 copies everything in
+    one step. progress(status, remaining, total) is called after every
+    step. A write from another connection makes sqlite start the copy over,
+    writes through this thread's pooled connection are picked up as it
+    goes.
+
+    The copy is written next to target and only moved over it once it is
+    complete and, with check, has passed PRAGMA integrity_check, so a
+    failed backup never replaces a good one. Returns target.
+    """
+    target = os.fspath(target)
+    partial = target + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    db = Database(db_file, profile=profile)
+    try:
+        with closing(sqlite3.connect(partial)) as dest:
+            db.conn.backup(dest, pages=pages, progress=progress, sleep=sleep)
+            if check:
+                verify(dest)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.replace(partial, target)
+    return target
+
+
+def verify(conn):
+    # Raise sqlite3.DatabaseError unless conn's database is consistent
+    problems = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+    if problems != ['ok']:
+        raise sqlite3.DatabaseError('backup failed integrity check: ' + '; '.join(problems))
+
+
+class BackupSchedule:
+    """ Back a database up every interval seconds on a background thread
+
+    target may contain strftime codes, e.g. 'backups/example-%Y%m%d%H%M.db',
+    to keep more than the latest copy. Options are passed to backup().
+    Failures are logged and kept in `error`, the next run still happens.
+
+        schedule = BackupSchedule('example.db', 'example.db.bak', interval=3600).start()
+        ...
+        schedule.stop()
+    """
+
+    def __init__(self, db_file, target, interval, logger=None, **options):
+        self.db_file = db_file
+        self.target = target
+        self.interval = interval
+        self.options = options
+        self.logger = logger or logging.getLogger('danql.backup')
+        self.last = None  # path of the last successful backup
+        self.error = None  # exception of the last run, None if it succeeded
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name=f'danql-backup-{self.db_file}', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        self._stop.set()
+        thread = self._thread
+        self._thread = None
+        if wait and thread is not None:
+            thread.join()
+
+    def run_once(self):
+        target = datetime.datetime.now().strftime(self.target)
+        try:
+            self.last = backup(self.db_file, target, **self.options)
+            self.error = None
+        except Exception as e:
+            self.error = e
+            self.logger.exception('backup of %s to %s failed', self.db_file, target)
+        return self.error is None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
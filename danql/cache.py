@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_CACHE_SIZE = 4096
+DEFAULT_COUNT_TTL = 60.0  # seconds before a cached row count is recounted
+
+
+class RowCache:
+    """ LRU cache of read_record results keyed by primary key tuple
+
+    Attach one to a Table (Table(..., row_cache=RowCache()) or
+    table.row_cache = RowCache()) and read_record calls that filter on
+    exactly the primary key are served from memory. update_record and
+    delete_record drop the keys they touch. Commits made by any other
+    connection, including other processes, are noticed through
+    PRAGMA data_version and clear the whole cache.
+
+    Attributes
+    ----------
+    maxsize : int
+        most keys kept before the least recently used is evicted
+    ttl : float or None
+        seconds an entry stays valid, None for no expiry
+    hits, misses : int
+        lookup counters for sizing the cache, see stats()
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()  # pk tuple -> (expires_at, rows)
+        self._versions = {}  # id(conn) -> (conn, data_version)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        # Return cached rows for key or None on a miss
+        with self._lock:
+            entry = self._rows.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                del self._rows[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def put(self, key, rows):
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._rows[key] = (expires_at, list(rows))
+            self._rows.move_to_end(key)
+            while len(self._rows) > self.maxsize:
+                self._rows.popitem(last=False)
+
+    def invalidate(self, keys=None):
+        # Drop keys, or everything when keys is None
+        with self._lock:
+            if keys is None:
+                self._rows.clear()
+                return
+            for key in keys:
+                self._rows.pop(key, None)
+
+    def check_data_version(self, conn):
+        # PRAGMA data_version changes when another connection commits, it
+        # is per connection so the last value seen is kept for each one.
+        # A connection not seen before could have missed a commit that
+        # another one saw first, so it clears the cache too
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        with self._lock:
+            seen = self._versions.get(id(conn))
+            if seen is not None and seen[0] is conn and seen[1] == version:
+                return
+            if len(self._versions) > 64:
+                self._versions.clear()
+            self._versions[id(conn)] = (conn, version)
+            self._rows.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._rows),
+            'maxsize': self.maxsize,
+        }
+
+
+class RowCount:
+    """ Approximate row count of one table, for callers polling it often
+
+    Attach one to a Table (table.count_cache = RowCount()) and
+    total_rows(approximate=True) answers from memory. It starts from a
+    count(*) and is moved by the rows create_record, create_records and
+    delete_record of every Table sharing it add and remove. Writes it
+    can't account for (other processes, raw sql, rolled back transactions)
+    are only picked up by the recount done after ttl seconds.
+    """
+
+    def __init__(self, ttl=DEFAULT_COUNT_TTL):
+        self.ttl = ttl
+        self._count = None
+        self._expires_at = None
+        self._lock = threading.Lock()
+
+    def get(self, table):
+        # Cached count, counting table's rows if there is none
+        with self._lock:
+            if self._count is not None and (
+                    self._expires_at is None or self._expires_at > time.monotonic()):
+                return self._count
+        count = table.total_rows()
+        with self._lock:
+            self._count = count
+            self._expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        return count
+
+    def adjust(self, delta):
+        # delta rows were added (or removed when negative), None if unknown
+        with self._lock:
+            if delta is None:
+                self._count = None
+            elif self._count is not None:
+                self._count = max(self._count + delta, 0)
+
+    def invalidate(self):
+        self.adjust(None)
@@ -0,0 +1,89 @@
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# array.array typecode and matching numpy dtype per sqlite type affinity
+TYPECODES = {'INTEGER': 'q', 'REAL': 'd'}
+DTYPES = {'q': 'int64', 'd': 'float64'}
+
+
+def affinity(decl_type):
+    # sqlite's rules for the type affinity of a declared column type
+    # See https://www.sqlite.org/datatype3.html#determination_of_column_affinity
+    decl_type = (decl_type or '').upper()
+    if 'INT' in decl_type:
+        return 'INTEGER'
+    if 'CHAR' in decl_type or 'CLOB' in decl_type or 'TEXT' in decl_type:
+        return 'TEXT'
+    if 'BLOB' in decl_type or decl_type == '':
+        return 'BLOB'
+    if 'REAL' in decl_type or 'FLOA' in decl_type or 'DOUB' in decl_type:
+        return 'REAL'
+    return 'NUMERIC'
+
+
+def fetch_columnar(cur, types=None, batch_size=1000):
+    """ Drain an executed cursor into a dict of column name -> array
+
+    Rows are fetched batch_size at a time and appended straight into one
+    array per column, so no per-row objects outlive a batch. Columns whose
+    declared type (types maps column name to Column.type) has INTEGER or
+    REAL affinity fill an array.array; when types doesn't know a column the
+    first non NULL value picks. A NULL or a value of another type turns the
+    column into a plain list. With numpy installed the result is numpy
+    arrays, typed ones wrap the array.array buffer without a copy and lists
+    become object arrays. A statement without a result set gives {}.
+    """
+    if cur.description is None:
+        return {}
+    types = types or {}
+    names = [d[0] for d in cur.description]
+    columns = []
+    for name in names:
+        if name in types:
+            typecode = TYPECODES.get(affinity(types[name]))
+            columns.append(array(typecode) if typecode else [])
+        else:
+            columns.append(None)  # decided by first non NULL value
+
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if len(rows) == 0:
+            break
+        for n in range(len(names)):
+            values = [row[n] for row in rows]
+            col = columns[n]
+            if col is None:
+                first = next((v for v in values if v is not None), None)
+                if first is None:
+                    # Still undecided, keep the NULLs in a list
+                    columns[n] = values
+                    continue
+                typecode = {int: 'q', float: 'd'}.get(type(first))
+                col = columns[n] = array(typecode) if typecode else []
+            if isinstance(col, array):
+                filled = len(col)
+                try:
+                    col.extend(values)
+                    continue
+                except (TypeError, OverflowError):
+                    del col[filled:]
+                    col = columns[n] = col.tolist()
+            col.extend(values)
+
+    result = {}
+    for name, col in zip(names, columns):
+        if col is None:
+            col = []
+        if numpy is not None:
+            if isinstance(col, array) and len(col) > 0:
+                col = numpy.frombuffer(col, dtype=DTYPES[col.typecode])
+            elif isinstance(col, array):
+                col = numpy.array([], dtype=DTYPES[col.typecode])
+            else:
+                col = numpy.array(col, dtype=object)
+        result[name] = col
+    return result
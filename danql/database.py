@@ -1,24 +1,57 @@
+import keyword
 import os
 import sqlite3
+import time
 from contextlib import closing
 
+from .columnar import fetch_columnar
+from .instrument import instrumentation
+from .pool import get_pool
+from .record import valid_slots
+
 class Database:
     # Base db class for handling connections and executing sql statements
     # Get db_file from env var, passed in filepath, or fall back to memory
-    def __init__(self, db_file=None):
+    # Connections are borrowed from the per db_file pool, see pool.py
+    # profile names the PRAGMAs new connections get, see pool.PROFILES,
+    # from the passed in name, the DANQL_PROFILE env var or 'default'
+    # Statements are reported to instrument.instrumentation hooks if any
+    def __init__(self, db_file=None, profile=None):
+        start = time.perf_counter()
         self.db_file = db_file
+        if profile is None:
+            profile = os.getenv('DANQL_PROFILE', 'default')
         if db_file is not None:
-            self.conn = sqlite3.connect(db_file)
+            self.pool = get_pool(db_file, profile=profile)
         else:
-            self.conn = sqlite3.connect(os.getenv('DANQL_DB_FILE', ':memory:'))
-        self.conn.row_factory = sqlite3.Row
+            self.pool = get_pool(os.getenv('DANQL_DB_FILE', ':memory:'), profile=profile)
+        self.conn = self.pool.connection()
         self.cur = self.conn.cursor()
+        self.wait = time.perf_counter() - start
 
-    def query(self, sql):
+    def query(self, sql, params=(), columnar=False, types=None, record_class=None):
         # Return List[sqlite3.Row] or List[]
+        # or with columnar a dict of column name -> array, see columnar.py
+        # or with record_class a List[record_class], see record.py
+        if instrumentation.hooks:
+            return instrumentation.run(
+                'query', self, sql, params,
+                lambda: self._query(sql, params, columnar, types, record_class))
+        return self._query(sql, params, columnar, types, record_class)
+
+    def _query(self, sql, params, columnar, types, record_class=None):
         try:
-            self.cur.execute(sql)
-            results = self.cur.fetchall()
+            self.cur.execute(sql, params)
+            if columnar:
+                return fetch_columnar(self.cur, types=types)
+            if record_class is not None and self.cur.description is not None:
+                self.cur.row_factory = record_class.row_factory(self.cur)
+                try:
+                    results = self.cur.fetchall()
+                finally:
+                    self.cur.row_factory = self.conn.row_factory
+            else:
+                results = self.cur.fetchall()
         except Exception as e:
             raise e
         if len(results) > 0:
@@ -26,16 +59,77 @@ class Database:
         else:
             return []
 
-    def insert(self, sql):
+    def settings(self):
+        # Return dict of the effective tuning PRAGMAs on this connection
+        return self.pool.settings(self.conn)
+
+    def iter_query(self, sql, params=(), batch_size=1000, record_class=None):
+        # Yield sqlite3.Row (or record_class) one at a time, fetched
+        # batch_size at a time from a cursor of its own. The cursor is
+        # closed, releasing its read lock, once the generator is exhausted
+        # or closed
+        cur = self.conn.cursor()
+        try:
+            cur.execute(sql, params)
+            if record_class is not None and cur.description is not None:
+                cur.row_factory = record_class.row_factory(cur)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                yield from rows
+        finally:
+            cur.close()
+
+    def insert(self, sql, params=()):
         # Return row_id of created row or None if row already exists
+        if instrumentation.hooks:
+            return instrumentation.run(
+                'insert', self, sql, params, lambda: self._insert(sql, params))
+        return self._insert(sql, params)
+
+    def _insert(self, sql, params):
         try:
-            self.cur.execute(sql)
+            self.cur.execute(sql, params)
             return self.cur.lastrowid
         except sqlite3.IntegrityError as e:
             return None
 
+    def insert_many(self, sql, seq_of_params):
+        # Insert every row with executemany, all or nothing
+        # Return True if all rows were inserted or False if any of them
+        # violated a constraint, in which case none of them are kept
+        if instrumentation.hooks:
+            return instrumentation.run(
+                'insert_many', self, sql, seq_of_params,
+                lambda: self._insert_many(sql, seq_of_params))
+        return self._insert_many(sql, seq_of_params)
+
+    def _insert_many(self, sql, seq_of_params):
+        if not self.conn.in_transaction:
+            self.cur.execute("BEGIN")
+        self.cur.execute("SAVEPOINT insert_many")
+        try:
+            self.cur.executemany(sql, seq_of_params)
+        except sqlite3.IntegrityError as e:
+            self.cur.execute("ROLLBACK TO insert_many")
+            self.cur.execute("RELEASE insert_many")
+            return False
+        self.cur.execute("RELEASE insert_many")
+        return True
+
     def from_sqlfile(self, sqlfile):
         # Return List[sqlite3.Row] or List[]
+        if instrumentation.hooks:
+            return instrumentation.run(
+                'script', self, sqlfile, (), lambda: self._from_sqlfile(sqlfile))
+        return self._from_sqlfile(sqlfile)
+
+    def _from_sqlfile(self, sqlfile):
+        # executescript COMMITs first, which would end a transaction (or
+        # break a savepoint) some other code still expects to roll back
+        if self.conn.in_transaction:
+            raise ValueError(f'{sqlfile} can not run inside an open transaction')
         try:
             with open(sqlfile, 'r') as f:
                 self.cur.executescript(f.read())
@@ -46,12 +140,23 @@ class Database:
             return results
         return []
 
-    def backup(self):
-        backup_file = self.db_file + '.bak'
-        self.query(f"VACUUM main INTO {backup_file}")
+    def transaction(self):
+        # Unit of work shared by Tables bound to it, see transaction.py
+        from .transaction import Transaction
+        return Transaction(self.db_file, profile=self.pool.profile)
 
-    def create_tables(self, sqlfiles, out_directory=None):
+    def backup(self, target=None, **options):
+        # Online copy to target (db_file + '.bak' by default) that doesn't
+        # lock writers out for the whole copy, see backup.backup for options
+        from .backup import backup
+        if target is None:
+            target = self.pool.db_file + '.bak'
+        return backup(self.pool.db_file, target, profile=self.pool.profile, **options)
+
+    def create_tables(self, sqlfiles=None, out_directory=None, sqlfile=None):
         # Create all tables in sqlfile and then create classes from them
+        if sqlfile is not None:
+            sqlfiles = [sqlfile]
         for sqlfile in sqlfiles:
             try:
                 self.from_sqlfile(sqlfile)
@@ -69,10 +174,11 @@ class Database:
             """)
         for table in tables:
             table = table[0]
-            class_definition = self.class_definition_from_table_name(table)
+            columns = [col['name'] for col in self.query(f"PRAGMA table_info({table})")]
+            class_definition = self.class_definition_from_table_name(table, columns)
             if out_directory is None:
                 print(class_definition)
-                return
+                continue
 
             out_directory = out_directory.strip('/')
             filepath = f'{out_directory}/{table}.py'
@@ -81,34 +187,74 @@ class Database:
             with open(filepath, 'w') as f:
                 f.write(class_definition)
             init_dot_py = f'{out_directory}/__init__.py'
+            camel_case = self.underscore_to_camelcase(table)
+            names = [camel_case]
+            if f'class {camel_case}Record(' in class_definition:
+                names.append(f'{camel_case}Record')
             with open(init_dot_py, 'a') as f:
-                f.write(f'from .{table} import {table.capitalize()}\n')
+                f.write(f'from .{table} import {", ".join(names)}\n')
 
     @staticmethod
-    def class_definition_from_table_name(table_name):
+    def underscore_to_camelcase(table_name):
+        return ''.join(x.capitalize() or '_' for x in table_name.split('_'))
 
-        def underscore_to_camelcase(table_name):
-            return ''.join(x.capitalize() or '_' for x in table_name.split('_'))
+    @classmethod
+    def class_definition_from_table_name(cls, table_name, columns=None):
+        # Table subclass for table_name, plus a __slots__ Record subclass
+        # when its columns are given and can all be slots, python
+        # identifiers that don't shadow Record's methods, see record.py
+        camel_case = cls.underscore_to_camelcase(table_name)
 
-        camel_case = underscore_to_camelcase(table_name)
+        if not columns or not valid_slots(columns):
+            template = f"""
+# {table_name}.py
+from danql import Database, Table
+
+class {camel_case}(Table):
+    def __init__(self, db_file=None):
+        super().__init__(table_name='{table_name}', db_file=db_file)
+"""
+            return template.lstrip()
+
+        slots = ', '.join(f"'{col}'" for col in columns)
+        if len(columns) == 1:
+            slots += ','
+        if any(keyword.iskeyword(col) for col in columns):
+            # Can't be argument names, Record's own __init__ sets them
+            init = ''
+        else:
+            args = ', '.join(f'{col}=None' for col in columns)
+            body = ''.join(f'\n        self.{col} = {col}' for col in columns)
+            init = f'\n    def __init__(self, {args}):{body}\n'
 
         template = f"""
 # {table_name}.py
-from danql import Database, Table
+from danql import Database, Record, Table
 
+class {camel_case}Record(Record):
+    __slots__ = ({slots})
+{init}
 class {camel_case}(Table):
+    record_class = {camel_case}Record
+
     def __init__(self, db_file=None):
         super().__init__(table_name='{table_name}', db_file=db_file)
 """
         return template.lstrip()
 
     def __enter__(self):
+        start = time.perf_counter()
+        conn = self.pool.begin()
+        if conn is not self.conn:
+            self.conn = conn
+            self.cur = conn.cursor()
+        self.wait += time.perf_counter() - start
         return self
 
     def __exit__(self, ext_type, exc_value, traceback):
+        # Connection goes back to the pool instead of being closed
         self.cur.close()
         if isinstance(exc_value, Exception):
-            self.conn.rollback()
+            self.pool.end(commit=False)
         else:
-            self.conn.commit()
-        self.conn.close()
+            self.pool.end(commit=True)
@@ -0,0 +1,233 @@
+import contextvars
+import functools
+import logging
+import random
+import re
+import threading
+import time
+
+# Table method currently running in this thread/task, set by traced()
+current_caller = contextvars.ContextVar('danql_caller', default=None)
+
+
+def traced(method):
+    # Record Table method calls as the caller of the sql they run
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not instrumentation.hooks:
+            return method(self, *args, **kwargs)
+        token = current_caller.set(f'{self.__class__.__name__}.{method.__name__}')
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            current_caller.reset(token)
+    return wrapper
+
+
+class Instrumentation:
+    """ Pre/post hooks around every statement Database runs
+
+    Database.query, insert, insert_many and from_sqlfile report to the
+    process wide `instrumentation` instance. Each hook is called with an
+    event dict:
+
+        kind      'query', 'insert', 'insert_many' or 'script'
+        sql       the statement (the file name for 'script')
+        params    the bound parameters
+        db_file   database the connection points at
+        caller    Table method that ran it, e.g. 'Dog.read_record', or None
+        wait      seconds Database spent getting its connection from the pool
+        conn      the sqlite3.Connection it ran on
+
+    and after the statement ran, also
+
+        elapsed   seconds spent in sqlite
+        rows      rows returned (query) or changed (insert, insert_many)
+        error     the exception raised, or None
+
+    With no hooks added statements run without any of this.
+    """
+
+    def __init__(self):
+        self.hooks = []  # (pre, post)
+        self._lock = threading.Lock()
+
+    def add_hook(self, pre=None, post=None):
+        # Returns the hook to pass to remove_hook
+        hook = (pre, post)
+        with self._lock:
+            self.hooks = self.hooks + [hook]
+        return hook
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self.hooks = [h for h in self.hooks if h is not hook]
+
+    def run(self, kind, db, sql, params, execute):
+        # Call execute() between the pre and post hooks
+        hooks = self.hooks
+        event = {
+            'kind': kind,
+            'sql': sql,
+            'params': params,
+            'db_file': db.pool.db_file,
+            'caller': current_caller.get(),
+            'wait': db.wait,
+            'conn': db.conn,
+        }
+        for pre, _ in hooks:
+            if pre is not None:
+                pre(event)
+        result = None
+        error = None
+        start = time.perf_counter()
+        try:
+            result = execute()
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            event['elapsed'] = time.perf_counter() - start
+            event['error'] = error
+            if kind == 'query' and isinstance(result, dict):
+                # columnar result
+                event['rows'] = len(next(iter(result.values()), []))
+            elif kind == 'query' and result is not None:
+                event['rows'] = len(result)
+            elif kind == 'insert_many':
+                event['rows'] = len(params) if result else 0
+            else:
+                event['rows'] = max(db.cur.rowcount, 0)
+            for _, post in hooks:
+                if post is not None:
+                    post(event)
+
+
+instrumentation = Instrumentation()
+
+
+_string_literal = re.compile(r"'(?:[^']|'')*'")
+_number_literal = re.compile(r'\b\d+(?:\.\d+)?\b')
+_placeholder_list = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*')
+_whitespace = re.compile(r'\s+')
+
+
+def statement_shape(sql):
+    # sql with literals replaced by ? and IN/VALUES lists of any length
+    # collapsed, so statements that differ only in values group together
+    shape = _string_literal.sub('?', sql)
+    shape = _number_literal.sub('?', shape)
+    shape = _placeholder_list.sub('(...)', shape)
+    return _whitespace.sub(' ', shape).strip()
+
+
+class SlowQueryLog:
+    """ Post hook logging statements slower than threshold seconds
+
+    With explain_sample > 0 that fraction of slow statements also logs its
+    EXPLAIN QUERY PLAN. The last maxlen slow statements are kept in
+    `entries` as dicts of sql, params, caller, elapsed, rows and plan.
+
+        slow_log = SlowQueryLog(threshold=0.05, explain_sample=0.1)
+        slow_log.install()
+    """
+
+    def __init__(self, threshold=0.1, explain_sample=0.0, maxlen=100,
+                 logger=None):
+        self.threshold = threshold
+        self.explain_sample = explain_sample
+        self.maxlen = maxlen
+        self.logger = logger or logging.getLogger('danql.slow')
+        self.entries = []
+        self.hook = None
+
+    def install(self):
+        self.hook = instrumentation.add_hook(post=self)
+        return self
+
+    def uninstall(self):
+        instrumentation.remove_hook(self.hook)
+        self.hook = None
+
+    def __call__(self, event):
+        if event['elapsed'] < self.threshold or event['kind'] == 'script':
+            return
+        plan = None
+        if self.explain_sample > 0 and random.random() < self.explain_sample:
+            params = event['params']
+            if event['kind'] == 'insert_many':
+                # sequence of parameters, explain with the first
+                params = params[0] if len(params) > 0 else ()
+            plan = explain(event['conn'], event['sql'], params)
+        entry = {
+            'sql': event['sql'],
+            'params': event['params'],
+            'caller': event['caller'],
+            'elapsed': event['elapsed'],
+            'rows': event['rows'],
+            'plan': plan,
+        }
+        self.entries = (self.entries + [entry])[-self.maxlen:]
+        self.logger.warning(
+            'slow query %.1fms rows=%s caller=%s: %s%s',
+            event['elapsed'] * 1000, event['rows'], event['caller'], event['sql'],
+            '' if plan is None else '\n  ' + '\n  '.join(plan))
+
+
+def explain(conn, sql, params=()):
+    # EXPLAIN QUERY PLAN detail lines for sql, or None if it can't be
+    # explained (e.g. it was a script or a PRAGMA)
+    try:
+        rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    except Exception:
+        return None
+    return [row[3] for row in rows]
+
+
+class StatementStats:
+    """ Post hook aggregating timings per statement shape
+
+    snapshot() returns {shape: {count, errors, rows, total, min, max}} with
+    times in seconds, ready to hand to a metrics pipeline. reset=True
+    starts a new interval.
+
+        stats = StatementStats().install()
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.hook = None
+        self._lock = threading.Lock()
+
+    def install(self):
+        self.hook = instrumentation.add_hook(post=self)
+        return self
+
+    def uninstall(self):
+        instrumentation.remove_hook(self.hook)
+        self.hook = None
+
+    def __call__(self, event):
+        shape = statement_shape(event['sql'])
+        elapsed = event['elapsed']
+        with self._lock:
+            stat = self.stats.get(shape)
+            if stat is None:
+                stat = self.stats[shape] = {
+                    'count': 0, 'errors': 0, 'rows': 0,
+                    'total': 0.0, 'min': elapsed, 'max': elapsed,
+                }
+            stat['count'] += 1
+            stat['errors'] += event['error'] is not None
+            stat['rows'] += event['rows']
+            stat['total'] += elapsed
+            stat['min'] = min(stat['min'], elapsed)
+            stat['max'] = max(stat['max'], elapsed)
+
+    def snapshot(self, reset=False):
+        with self._lock:
+            snapshot = {shape: dict(stat) for shape, stat in self.stats.items()}
+            if reset:
+                self.stats = {}
+        return snapshot
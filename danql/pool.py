@@ -0,0 +1,200 @@
+import os
+import sqlite3
+import threading
+
+DEFAULT_POOL_SIZE = int(os.getenv('DANQL_POOL_SIZE', '8'))
+CACHED_STATEMENTS = int(os.getenv('DANQL_CACHED_STATEMENTS', '256'))
+
+# PRAGMAs applied once to every new connection, picked by name with
+# Database(profile=...), Table(profile=...) or the DANQL_PROFILE env var
+# See https://www.sqlite.org/pragma.html
+PROFILES = {
+    'default': {
+        'busy_timeout': 5000,
+    },
+    'throughput': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 268435456,  # 256MB
+        'cache_size': -65536,  # 64MB
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+    },
+    'readonly': {
+        'query_only': 1,
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+    },
+}
+TUNING_PRAGMAS = (
+    'journal_mode', 'synchronous', 'mmap_size', 'cache_size',
+    'temp_store', 'busy_timeout', 'query_only',
+)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """ Per-thread sqlite3 connections to a single database file
+
+    Every thread that asks for a connection gets its own, and keeps it
+    between calls so Database/Table don't pay for sqlite3.connect and close
+    on every statement. At most max_size connections are kept open; threads
+    past that get a connection that is closed once they are done with it.
+
+    Nested `with Database(...)` blocks in one thread share the connection
+    and only the outermost block commits or rolls back. A Database used
+    outside of a with block shares it too, its uncommitted writes are
+    committed or rolled back by whichever outermost block ends next.
+    """
+
+    def __init__(self, db_file, max_size=DEFAULT_POOL_SIZE, profile='default'):
+        if profile not in PROFILES:
+            raise ValueError(f'Unknown profile {profile}')
+        self.db_file = db_file
+        self.max_size = max_size
+        self.profile = profile
+        self._connections = {}  # thread ident -> sqlite3.Connection
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def connect(self):
+        # check_same_thread is off so close_all() can close connections
+        # that belong to other threads, each one is still only used by one
+        conn = sqlite3.connect(
+            self.db_file,
+            check_same_thread=False,
+            cached_statements=CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        for pragma, value in PROFILES[self.profile].items():
+            conn.execute(f"PRAGMA {pragma}={value}").fetchall()
+        return conn
+
+    @staticmethod
+    def settings(conn):
+        # Effective values of TUNING_PRAGMAS on conn
+        return {
+            pragma: conn.execute(f"PRAGMA {pragma}").fetchone()[0]
+            for pragma in TUNING_PRAGMAS
+        }
+
+    def connection(self):
+        # Return the calling thread's connection, opening one if needed
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None and getattr(local, 'depth', 0) > 0:
+            return conn
+        if conn is not None and not self.healthy(conn):
+            self._discard(conn)
+            conn = None
+        if conn is None:
+            conn = self.connect()
+            with self._lock:
+                if len(self._connections) >= self.max_size:
+                    self._prune()
+                local.pooled = len(self._connections) < self.max_size
+                if local.pooled:
+                    self._connections[threading.get_ident()] = conn
+            local.conn = conn
+            local.depth = 0
+        return conn
+
+    def begin(self):
+        # Enter a unit of work on this thread's connection
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.connection()
+        self._local.depth += 1
+        return conn
+
+    def depth(self):
+        # How many units of work this thread is inside of
+        return getattr(self._local, 'depth', 0)
+
+    def end(self, commit=True):
+        # Leave a unit of work, committing or rolling back if outermost
+        # Returns True if this call finished the transaction
+        local = self._local
+        local.depth -= 1
+        if local.depth > 0:
+            return False
+        conn = local.conn
+        if commit:
+            conn.commit()
+        else:
+            conn.rollback()
+        if not local.pooled:
+            conn.close()
+            local.conn = None
+        return True
+
+    @staticmethod
+    def healthy(conn):
+        # An open transaction is left alone, it belongs to a Database used
+        # outside of a with block and the next block to end decides it
+        try:
+            conn.execute('SELECT 1').fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def size(self):
+        return len(self._connections)
+
+    def close_all(self):
+        # Close every pooled connection, threads reconnect on next use
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def _discard(self, conn):
+        with self._lock:
+            for ident, pooled in list(self._connections.items()):
+                if pooled is conn:
+                    del self._connections[ident]
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self._local.conn = None
+
+    def _prune(self):
+        # Drop connections owned by threads that have exited
+        alive = set(t.ident for t in threading.enumerate())
+        for ident in list(self._connections):
+            if ident not in alive:
+                conn = self._connections.pop(ident)
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+
+
+def get_pool(db_file, max_size=DEFAULT_POOL_SIZE, profile='default'):
+    # Return the process wide pool for db_file and profile, creating it on
+    # first use
+    key = (db_file, profile)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(db_file, max_size=max_size, profile=profile)
+                _pools[key] = pool
+    return pool
+
+
+def close_all():
+    # Close every connection in every pool
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_all()
@@ -0,0 +1,125 @@
+import os
+import re
+import threading
+import time
+
+from .database import Database
+
+DEFAULT_CHECK_INTERVAL = 1.0  # seconds between mtime checks
+
+_name_marker = re.compile(r'^--\s*name:\s*(\w+)\s*$', re.MULTILINE)
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+class QueryRegistry:
+    """ Named sql statements loaded from a directory of .sql files
+
+    Every .sql file is read once and kept in memory. A file holding one
+    statement is named after the file, get_breeds.sql is 'get_breeds'. A
+    file holding several names each one with a comment line above it:
+
+        -- name: dogs_by_owner
+        SELECT * FROM dog WHERE owner_id = :owner_id
+
+        -- name: dog_count
+        SELECT count(*) FROM dog
+
+    Statements take ? or :name parameters and run through Database.query,
+    so sqlite prepares them once per connection. Files are stat'ed at most
+    every check_interval seconds and re-read only when their mtime changes,
+    new and removed files are picked up the same way.
+
+        queries = get_query_registry('sql')
+        with Database(db_file) as db:
+            rows = db.query(queries.sql('dogs_by_owner'), {'owner_id': 1})
+    """
+
+    def __init__(self, directory, check_interval=DEFAULT_CHECK_INTERVAL):
+        self.directory = directory
+        self.check_interval = check_interval
+        self.statements = {}  # name -> sql
+        self._files = {}  # path -> (mtime, names)
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.reload()
+
+    def sql(self, name):
+        self._check()
+        try:
+            return self.statements[name]
+        except KeyError:
+            raise KeyError(f'no query named {name} in {self.directory}') from None
+
+    def names(self):
+        self._check()
+        return sorted(self.statements)
+
+    def query(self, name, params=(), db_file=None, profile=None, **options):
+        # Run the named statement, options are passed to Database.query
+        sql = self.sql(name)
+        with Database(db_file, profile=profile) as db:
+            return db.query(sql, params, **options)
+
+    def reload(self):
+        # Re-read the files whose mtime changed since they were loaded
+        with self._lock:
+            paths = {
+                os.path.join(self.directory, f): None
+                for f in sorted(os.listdir(self.directory)) if f.endswith('.sql')
+            }
+            for path in paths:
+                paths[path] = os.stat(path).st_mtime_ns
+            changed = [
+                path for path, mtime in paths.items()
+                if path not in self._files or self._files[path][0] != mtime
+            ]
+            removed = [path for path in self._files if path not in paths]
+            if changed or removed:
+                statements = dict(self.statements)
+                files = dict(self._files)
+                for path in changed + removed:
+                    for name in files.pop(path, (None, ()))[1]:
+                        statements.pop(name, None)
+                for path in changed:
+                    loaded = self.parse(path)
+                    for name in loaded:
+                        if name in statements:
+                            raise ValueError(f'query {name} in {path} is already defined')
+                    statements.update(loaded)
+                    files[path] = (paths[path], tuple(loaded))
+                self.statements = statements
+                self._files = files
+            self._checked = time.monotonic()
+
+    def _check(self):
+        if time.monotonic() - self._checked >= self.check_interval:
+            self.reload()
+
+    @staticmethod
+    def parse(path):
+        # Returns {name: sql} for the statements in path
+        with open(path, 'r') as f:
+            text = f.read()
+        parts = _name_marker.split(text)
+        if len(parts) == 1:
+            name = os.path.splitext(os.path.basename(path))[0]
+            return {name: text.strip().rstrip(';').strip()}
+        statements = {}
+        for name, sql in zip(parts[1::2], parts[2::2]):
+            if name in statements:
+                raise ValueError(f'query {name} is defined twice in {path}')
+            statements[name] = sql.strip().rstrip(';').strip()
+        return statements
+
+
+def get_query_registry(directory, **options):
+    # Return the process wide QueryRegistry for directory
+    key = os.path.abspath(directory)
+    with _registries_lock:
+        registry = _registries.get(key)
+        if registry is None:
+            registry = QueryRegistry(directory, **options)
+            _registries[key] = registry
+    return registry
@@ -0,0 +1,92 @@
+class Record:
+    """ Base class for typed __slots__ rows
+
+    Database.create_tables generates one subclass per table with a slot per
+    column, e.g.
+
+        class DogRecord(Record):
+            __slots__ = ('breed_id', 'owner_id', 'name')
+
+    Records are built straight from cursor tuples (see from_tuple) so each
+    row is allocated once, without a sqlite3.Row in between. Like
+    sqlite3.Row they support keys(), record['column'], record[0], len()
+    and iterating over values, so they can be passed back to
+    update_record/delete_record.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        # Generated subclasses define their own, faster __init__
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+        for name in self.__slots__[len(args):]:
+            setattr(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError(f'unexpected columns {", ".join(kwargs)}')
+
+    @classmethod
+    def from_tuple(cls, cursor, row):
+        # row_factory for queries returning exactly the record's columns in
+        # order, e.g. SELECT * FROM the table
+        return cls(*row)
+
+    @classmethod
+    def from_named_tuple(cls, cursor, row):
+        # row_factory for queries returning a subset or other order of the
+        # record's columns
+        return cls(**{d[0]: value for d, value in zip(cursor.description, row)})
+
+    @classmethod
+    def row_factory(cls, cursor):
+        # Pick from_tuple or from_named_tuple for an executed cursor
+        names = tuple(d[0] for d in cursor.description)
+        if names == cls.__slots__:
+            return cls.from_tuple
+        return cls.from_named_tuple
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            key = self.__slots__[key]
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise IndexError(f'No item with that key: {key}')
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return tuple(self) == tuple(other)
+
+    def __repr__(self):
+        values = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{self.__class__.__name__}({values})'
+
+
+# Column names that can't be slots, they would replace Record's own
+# attributes or clash with the self argument of __init__
+RESERVED_NAMES = frozenset(dir(Record)) | {'self'}
+
+
+def valid_slots(columns):
+    # True if every column can be a slot of a Record subclass
+    return all(col.isidentifier() and col not in RESERVED_NAMES for col in columns)
+
+
+def make_record_class(name, columns):
+    # Record subclass built at runtime for tables without a generated one
+    if not valid_slots(columns):
+        raise ValueError(f'{name} can not have slots named {", ".join(columns)}')
+    return type(name, (Record,), {'__slots__': tuple(columns)})
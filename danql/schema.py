@@ -0,0 +1,122 @@
+import threading
+
+from .database import Database
+
+
+class SchemaCache:
+    """ Process wide cache of table metadata
+
+    Holds the PRAGMA table_info, index_list/index_info and foreign_key_list
+    output of every table and view in a database, keyed by (db_file,
+    lower cased table_name) since sqlite names are case insensitive. A
+    database is loaded in one pass over all of its tables and reloaded only
+    when PRAGMA schema_version says the schema has changed, so building a
+    Table costs a single cheap PRAGMA once the cache is warm. Names not in
+    sqlite_master (e.g. temp tables) are looked up on their own.
+    """
+
+    def __init__(self):
+        self._tables = {}    # (db_file, table_name) -> dict
+        self._versions = {}  # db_file -> schema_version it was loaded at
+        self._lock = threading.Lock()
+
+    def table(self, db_file, table_name, profile=None):
+        # Return dict with table_info, indexes and parents for table_name
+        with Database(db_file, profile=profile) as db:
+            key = db.pool.db_file
+            version = db.query("PRAGMA schema_version")[0][0]
+            if self._versions.get(key) != version:
+                self._load(db, key, version)
+            table = self._tables.get((key, table_name.lower()))
+            if table is None:
+                table = self._load_table(db, key, table_name)
+        return table
+
+    def warm(self, db_file=None, profile=None):
+        # Load every table of db_file now, e.g. at process start
+        with Database(db_file, profile=profile) as db:
+            version = db.query("PRAGMA schema_version")[0][0]
+            self._load(db, db.pool.db_file, version)
+
+    def invalidate(self, db_file=None):
+        # Forget db_file, or everything when db_file is None
+        with self._lock:
+            if db_file is None:
+                self._tables.clear()
+                self._versions.clear()
+                return
+            self._versions.pop(db_file, None)
+            for key in [k for k in self._tables if k[0] == db_file]:
+                del self._tables[key]
+
+    @staticmethod
+    def _empty():
+        return {'table_info': [], 'indexes': set(), 'parents': []}
+
+    def _load(self, db, key, version):
+        # One query per PRAGMA for all tables at once via the
+        # pragma table-valued functions
+        tables = {}
+        columns = db.query(
+            """
+            SELECT m.name AS table_name, p.*
+            FROM sqlite_master AS m, pragma_table_info(m.name) AS p
+            WHERE m.type IN ('table', 'view') AND m.name NOT LIKE 'sqlite_%'
+            ORDER BY m.name, p.cid
+            """)
+        for col in columns:
+            info = dict(col)
+            table = tables.setdefault(info.pop('table_name').lower(), self._empty())
+            table['table_info'].append(info)
+
+        indexed = db.query(
+            """
+            SELECT m.name AS table_name, ii.name AS column_name
+            FROM sqlite_master AS m,
+                 pragma_index_list(m.name) AS il,
+                 pragma_index_info(il.name) AS ii
+            WHERE m.type IN ('table', 'view') AND m.name NOT LIKE 'sqlite_%'
+            """)
+        for idx in indexed:
+            table = tables.setdefault(idx['table_name'].lower(), self._empty())
+            table['indexes'].add(idx['column_name'])
+
+        fks = db.query(
+            """
+            SELECT m.name AS table_name, p.*
+            FROM sqlite_master AS m, pragma_foreign_key_list(m.name) AS p
+            WHERE m.type IN ('table', 'view') AND m.name NOT LIKE 'sqlite_%'
+            ORDER BY m.name, p.id, p.seq
+            """)
+        for fk in fks:
+            info = dict(fk)
+            table = tables.setdefault(info.pop('table_name').lower(), self._empty())
+            table['parents'].append(info)
+
+        with self._lock:
+            for stale in [k for k in self._tables if k[0] == key]:
+                del self._tables[stale]
+            for table_name, table in tables.items():
+                self._tables[(key, table_name)] = table
+            self._versions[key] = version
+
+    def _load_table(self, db, key, table_name):
+        # PRAGMAs for one table sqlite_master doesn't list, cached only if
+        # it exists
+        table = self._empty()
+        table['table_info'] = [
+            dict(col) for col in db.query("SELECT * FROM pragma_table_info(?)", (table_name,))]
+        for idx in db.query(
+                "SELECT ii.name FROM pragma_index_list(?) AS il, pragma_index_info(il.name) AS ii",
+                (table_name,)):
+            table['indexes'].add(idx['name'])
+        table['parents'] = [
+            dict(fk) for fk in db.query(
+                "SELECT * FROM pragma_foreign_key_list(?) ORDER BY id, seq", (table_name,))]
+        if len(table['table_info']) > 0:
+            with self._lock:
+                self._tables[(key, table_name.lower())] = table
+        return table
+
+
+schema_cache = SchemaCache()
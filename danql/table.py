@@ -1,18 +1,203 @@
+import base64
+import copy
+import functools
+import json
 import logging
 import os
-import itertools
+import sqlite3
 
 from .database import Database
+from .instrument import traced
+from .pool import CACHED_STATEMENTS
+from .record import make_record_class
+from .schema import schema_cache
 
 if os.getenv('DEBUG', None) is not None:
     logging.basicConfig(format='%(message)s', level=logging.DEBUG)
 
+DEFAULT_BATCH_SIZE = 1000
+SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+# SQLITE_MAX_VARIABLE_NUMBER default, raised from 999 in 3.32.0
+MAX_VARIABLES = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+
+
+@functools.lru_cache(maxsize=CACHED_STATEMENTS)
+def compile_statement(operation, table_name, columns, not_equal=False, set_columns=(),
+                      in_rows=0, returning=False, order_by=(), after=False, limit=False,
+                      aggregates=(), group_by=()):
+    # Build ?-parameterized sql for one of the CRUD operations
+    # columns are the WHERE columns (insert: the VALUES columns) and
+    # set_columns the columns an update assigns. Parameters are bound in the
+    # order set_columns then columns. Same shape -> same string, so sqlite3's
+    # per-connection statement cache only prepares it once
+    # With in_rows the WHERE matches any of in_rows value tuples of columns:
+    # col IN (?,?) or for several columns
+    # (a,b) IN (SELECT column1,column2 FROM (VALUES (?,?),(?,?)))
+    # returning is True for RETURNING * or a tuple of columns to return
+    # An upsert is an insert that does nothing on a unique conflict, or sets
+    # set_columns to themselves, a no-op write that still RETURNs the row
+    # it conflicted with (sqlite >= 3.35 allows leaving out the conflict
+    # target so this covers every unique constraint)
+    # A select can be ordered by order_by, a tuple of (column, descending),
+    # start after a row (after is True or a keyset_state, keyset_params
+    # binds its order_by values) and take a LIMIT ? bound last
+    # An aggregate selects group_by and aggregates, (function, column)
+    # pairs each named function_column ('count' for count(*))
+    if in_rows > 0:
+        if len(columns) == 1:
+            placeholders = ','.join('?' for _ in range(in_rows))
+            where = f'{columns[0]} IN ({placeholders})'
+        else:
+            # IN (VALUES ...) straight away is planned as a full table scan,
+            # selecting from it lets sqlite search the primary key index
+            row = '(' + ','.join('?' for _ in columns) + ')'
+            placeholders = ','.join(row for _ in range(in_rows))
+            selected = ','.join(f'column{n + 1}' for n in range(len(columns)))
+            where = (f"({','.join(columns)}) IN "
+                     f"(SELECT {selected} FROM (VALUES {placeholders}))")
+    else:
+        op = '!=' if not_equal else '='
+        where = ' AND '.join(f'{col}{op}?' for col in columns)
+    if after:
+        keyset = keyset_condition(order_by, None if after is True else after)
+        where = f'{where} AND {keyset}' if where else keyset
+    where = f' WHERE {where}' if where else ''
+    if isinstance(returning, tuple):
+        returning = f" RETURNING {','.join(returning)}"
+    else:
+        returning = ' RETURNING *' if returning else ''
+    if operation == 'insert':
+        placeholders = ','.join('?' for _ in columns)
+        return f"INSERT INTO {table_name} ({','.join(columns)}) VALUES ({placeholders})"
+    elif operation == 'upsert':
+        placeholders = ','.join('?' for _ in columns)
+        if set_columns:
+            assignments = ','.join(f'{col}={col}' for col in set_columns)
+            action = f'DO UPDATE SET {assignments}'
+        else:
+            action = 'DO NOTHING'
+        return (f"INSERT INTO {table_name} ({','.join(columns)}) VALUES ({placeholders}) "
+                f"ON CONFLICT {action}{returning}")
+    elif operation == 'select':
+        order = ','.join(f"{col}{' DESC' if desc else ''}" for col, desc in order_by)
+        order = f' ORDER BY {order}' if order else ''
+        limit = ' LIMIT ?' if limit else ''
+        return f"SELECT * FROM {table_name}{where}{order}{limit}"
+    elif operation == 'count':
+        return f"SELECT count(*) FROM {table_name}{where}"
+    elif operation == 'aggregate':
+        selected = list(group_by) + [
+            f'{func}(*) AS {func}' if col == '*' else f'{func}({col}) AS {func}_{col}'
+            for func, col in aggregates
+        ]
+        group = f" GROUP BY {','.join(group_by)}" if group_by else ''
+        return f"SELECT {','.join(selected)} FROM {table_name}{where}{group}"
+    elif operation == 'update':
+        assignments = ','.join(f'{col}=?' for col in set_columns)
+        return f"UPDATE {table_name} SET {assignments}{where}{returning}"
+    elif operation == 'delete':
+        return f"DELETE FROM {table_name}{where}{returning}"
+    raise ValueError(f'Unsupported operation {operation}')
+
+
+def pad_in_rows(keys):
+    # keys padded with copies of the last one to the next power of two, so
+    # IN lists of any length compile to one of a few statement shapes
+    # instead of one per length, duplicates don't change what matches
+    bucket = 1 << (len(keys) - 1).bit_length()
+    return keys + [keys[-1]] * (bucket - len(keys))
+
+
+def in_rows_chunk_size(variables, per_row):
+    # Largest power of two number of rows fitting in variables parameters
+    rows = max(1, variables // per_row)
+    return 1 << (rows.bit_length() - 1)
+
+
+def keyset_condition(order_by, state=None):
+    # WHERE condition for rows after a row in order_by order. state has
+    # for every column 'value', 'nullable' (a value in a column that can
+    # also hold NULL) or 'null' (the row has NULL there), see keyset_state
+    # Ascending without NULLs, or any direction on NOT NULL columns, is a
+    # row value comparison sqlite can search an index with. Anything else
+    # expands to (a>?) OR (a=? AND b<?) ... with sqlite's NULL order, NULL
+    # before every value ascending and after every value descending
+    if state is None:
+        state = ('value',) * len(order_by)
+    if _keyset_row_value(order_by, state):
+        columns = [col for col, _ in order_by]
+        op = '<' if order_by[0][1] else '>'
+        placeholders = ','.join('?' for _ in columns)
+        return f"({','.join(columns)}) {op} ({placeholders})"
+    terms = []
+    for n, (col, desc) in enumerate(order_by):
+        if desc and state[n] == 'null':
+            # nothing comes after NULL descending
+            continue
+        equal = [
+            f'{c} IS NULL' if s == 'null' else f'{c}=?'
+            for (c, _), s in zip(order_by[:n], state[:n])
+        ]
+        if state[n] == 'null':
+            later = f'{col} IS NOT NULL'
+        elif desc and state[n] == 'nullable':
+            later = f'({col}<? OR {col} IS NULL)'
+        else:
+            later = f"{col}{'<' if desc else '>'}?"
+        terms.append('(' + ' AND '.join(equal + [later]) + ')')
+    if len(terms) == 0:
+        return '0'
+    return '(' + ' OR '.join(terms) + ')'
+
+
+def keyset_params(order_by, values, state=None):
+    # Parameters for keyset_condition(order_by, state) given the last
+    # row's values
+    if state is None:
+        state = ('value',) * len(order_by)
+    if _keyset_row_value(order_by, state):
+        return list(values)
+    params = []
+    for n, (col, desc) in enumerate(order_by):
+        if desc and state[n] == 'null':
+            continue
+        params.extend(v for v in values[:n] if v is not None)
+        if values[n] is not None:
+            params.append(values[n])
+    return params
+
+
+def keyset_state(values, nullable):
+    # keyset_condition state for the last row's values, nullable is a
+    # bool per order_by column
+    return tuple(
+        'null' if value is None else 'nullable' if can_be_null else 'value'
+        for value, can_be_null in zip(values, nullable))
+
+
+def _keyset_row_value(order_by, state):
+    directions = set(desc for _, desc in order_by)
+    if len(directions) != 1 or 'null' in state:
+        return False
+    return not directions.pop() or all(s == 'value' for s in state)
+
+
+class Page(list):
+    # One page of read_record(limit=...) rows. after is the continuation
+    # token to pass as read_record(after=...) for the next page, None when
+    # this was the last one
+    def __init__(self, rows, after=None):
+        super().__init__(rows)
+        self.after = after
+
 class Table:
     """ Abstract database table class
 
     All attributes besides db_file and table_name are properties set on init
     by querying the sqlite database with PRAGMA statements.
     See https://www.sqlite.org/pragma.html for PRAGMA docs.
+    The PRAGMA output is shared between instances through schema.schema_cache
+    and only re-read when the database's schema_version changes.
 
     Attributes
     ----------
@@ -20,6 +205,8 @@ class Table:
         sqlite database filepath
     table_name : str
         name of table in sqlite database
+    profile : str or None
+        connection tuning profile passed on to Database, see pool.PROFILES
     columns : dict
         keys are column names, values are Column class
     indexes : set
@@ -30,13 +217,61 @@ class Table:
         list of parent tables and column relationships
     foreign_keys: set
         set of column names that are foreign_keys
+    upsert : str or None
+        how create_record handles a unique conflict on sqlite >= 3.35:
+        'nothing' (default) INSERT ... ON CONFLICT DO NOTHING RETURNING pks
+        and select the existing row only if nothing came back, 'update'
+        ON CONFLICT DO UPDATE SET pk=pk (a no-op write, the existing row is
+        left as it is) so the pks of the conflicting row come back from the
+        insert itself, even when its other columns differ, None catches the
+        IntegrityError like older sqlite versions
+    row_cache : cache.RowCache or None
+        optional cache for read_record calls filtering on the primary key
+    index_advisor : advisor.IndexAdvisor or None
+        optional recorder of read_record/count_where filter columns
+    write_queue : writer.WriteQueue or None
+        optional background writer create_record, update_record and
+        delete_record hand their writes to so they commit in groups, except
+        inside a transaction on the calling thread where they run inline
+    count_cache : cache.RowCount or None
+        optional row count total_rows(approximate=True) answers from,
+        moved by this table's creates and deletes
+    transaction : transaction.Transaction or None
+        set on the copies bind() returns, every method runs on it
+    record_class : record.Record subclass or None
+        __slots__ row class create_tables generates for the table, returned
+        by read_record/iter_records(as_records=True)
 
     Methods
     -------
+    database():
+        Database for db_file and profile, or the bound transaction's
+    bind(transaction):
+        copy of the table running every method inside transaction
+    schema():
+        cached PRAGMA output used to set the properties above
     create_record(**kwargs):
         inserts a single row
-    read_record(not_equal=False, **kwargs):
-        gets all rows in table constructing WHERE clause from kwargs
+    create_records(rows, batch_size=DEFAULT_BATCH_SIZE):
+        inserts many rows, one transaction per batch
+    read_record(not_equal=False, columnar=False, order_by=None, limit=None,
+                after=None, as_records=False, include=None, **kwargs):
+        gets all rows in table constructing WHERE clause from kwargs,
+        optionally ordered and keyset paged, with parent rows included
+    include_parents(rows, include):
+        adds the parent rows referenced by rows' foreign keys
+    parent_key(name):
+        foreign key columns for a parent included by name
+    get_record_class():
+        record_class, built from columns if the table doesn't have one
+    order_keys(order_by, keyset=False):
+        parses read_record's order_by
+    nullable(column):
+        whether column can hold NULL, used by keyset paging
+    encode_token(values) / decode_token(token, length):
+        read_record continuation tokens
+    iter_records(batch_size=DEFAULT_BATCH_SIZE, not_equal=False, as_records=False, **kwargs):
+        generator version of read_record fetching batch_size rows at a time
     update_record(rows, not_equal=False, **kwargs):
         updates every row in rows to values in kwargs
     delete_record(rows):
@@ -46,26 +281,47 @@ class Table:
     sanitize_kwargs(**kwargs):
         transforms kwargs into sanitized lists of columns and values
     primary_keys_from_rows(rows)
-        used by update_record and delete_record
-    total_rows():
-        get total number of rows in table
+        primary key values of rows, used by update_record and delete_record
+    primary_key_chunks(rows, reserved=0):
+        primary_keys_from_rows split to fit sqlite's bound parameter limit
+    total_rows(approximate=False):
+        get total number of rows in table, or count_cache's estimate
     count_where(not_equal=False, **kwargs):
         gets count of rows constructing WHERE clause from kwargs
+    aggregate(group_by=None, count=True, sum=None, min=None, max=None, not_equal=False, **kwargs):
+        count, sum, min and max of rows matching kwargs, per group_by group
     sqlfile_query(sqlfile):
         load queries from a sqlfile too complex for basic CRUD methods
-    raw_query(sql):
+    named_query(name, params=(), columnar=False):
+        run a statement from the queries registry with bound parameters
+    raw_query(sql, columnar=False):
         execute arbitrary sql statement
+    column_types():
+        column name to declared type, used for columnar results
     column_equal_value(col_val_pairs, not_equal=False):
         helper function for constructing WHERE clauses
     properly_quoted(values):
         helper function for sanitizing values before making queries
     """
 
+    record_class = None
+    queries = None  # QueryRegistry used by named_query, see queries.py
+
     def __init__(self, table_name, columns={}, db_file=None, indexes=set(),
-                 primary_keys=[], foreign_keys=set(), parents=[]):
+                 primary_keys=[], foreign_keys=set(), parents=[], upsert='nothing',
+                 row_cache=None, profile=None, index_advisor=None, write_queue=None):
 
         self.db_file = db_file
+        self.profile = profile
         self.table_name = table_name
+        self.upsert = upsert
+        self.row_cache = row_cache
+        self.index_advisor = index_advisor
+        self.write_queue = write_queue
+        self.count_cache = None
+        self.transaction = None
+        self._schema = None
+        self._checked_write_queue = None
         self.columns = columns
         self.indexes = indexes
         self.primary_keys = primary_keys
@@ -78,14 +334,11 @@ class Table:
     @columns.setter
     def columns(self, columns):
         if len(columns.keys()) > 0:
-            self.__columns = self.columns
+            self.__columns = columns
         else:
-            sql = "PRAGMA table_info(%s)" % (self.table_name,)
-            with Database(self.db_file) as db:
-                schema = db.query(sql)
             # TODO better var name than to_set
             to_set = {}
-            for col in schema:
+            for col in self.schema()['table_info']:
                 name = col['name']
                 nullable = False if col['notnull'] else True
                 pk = True if col['pk'] else False
@@ -108,17 +361,7 @@ class Table:
         if len(indexes) > 0:
             self.__indexes = indexes
         else:
-            with Database(self.db_file) as db:
-                index_info = [
-                    db.query(f"PRAGMA index_info({i['name']})")
-                    for i in db.query(f"PRAGMA index_list({self.table_name})")
-                ]
-            indexed_columns = [
-                idx['name'] for row in index_info
-                for idx in row
-                if len(index_info) > 0
-            ]
-            self.__indexes = set(indexed_columns)
+            self.__indexes = set(self.schema()['indexes'])
 
     @property
     def primary_keys(self):
@@ -139,12 +382,7 @@ class Table:
         if len(parents) > 0:
             self.__parents = parents
         else:
-            with Database(self.db_file) as db:
-                fks = db.query(f"PRAGMA foreign_key_list({self.table_name})")
-            if len(fks) > 0:
-                self.__parents = [dict(fk) for fk in fks]
-            else:
-                self.__parents = []
+            self.__parents = [dict(fk) for fk in self.schema()['parents']]
 
     @property
     def foreign_keys(self):
@@ -156,82 +394,459 @@ class Table:
         else:
             self.__foreign_keys = set([parent['from'] for parent in self.parents])
 
+    def database(self):
+        # Database every method of this table runs its sql on
+        if self.transaction is not None:
+            return self.transaction.database()
+        return Database(self.db_file, profile=self.profile)
+
+    def bind(self, transaction):
+        # Shallow copy sharing the schema, caches and advisor whose methods
+        # all run inside transaction, see transaction.Transaction
+        if Database(self.db_file, profile=self.profile).pool is not transaction.database().pool:
+            raise ValueError(f'{self.table_name} is not in the transaction\'s database')
+        transaction.track(self)
+        bound = copy.copy(self)
+        bound.transaction = transaction
+        # queued writes would commit on the writer's connection instead
+        bound.write_queue = None
+        return bound
+
+    def schema(self):
+        # PRAGMA output for this table from the shared schema cache,
+        # looked up once per instance
+        if self._schema is None:
+            self._schema = schema_cache.table(self.db_file, self.table_name, profile=self.profile)
+        return self._schema
+
+    @traced
     def create_record(self, **kwargs):
         # Return newly created row_id/pk
         # or return existing row_id/pk of those values
         # if inserting those values raises
         # a sqlite3.IntegrityError (violated unique constraint)
+        if self._queue_writes():
+            return self.write_queue.create_record(self, **kwargs).result()
         columns, values = self.sanitize_kwargs(**kwargs)
-        columns = ','.join(columns)
-        values = self.properly_quoted(values)
-        sql = f"INSERT INTO {self.table_name} ({columns}) VALUES ({values})"
+        if self.upsert is not None and SUPPORTS_RETURNING and len(self.primary_keys) > 0:
+            return self._upsert_record(tuple(columns), values)
+        sql = compile_statement('insert', self.table_name, tuple(columns))
         logging.debug(sql)
-        with Database(self.db_file) as db:
-            new_row_id = db.insert(sql)
+        with self.database() as db:
+            new_row_id = db.insert(sql, values)
         if new_row_id is not None:
+            self._rows_added(1)
             return new_row_id
 
         logging.debug('Row already exists')
         existing_row = self.read_record(**kwargs)[0]
-        existing_row_id = [existing_row[x] for x in self.primary_keys]
-        if len(existing_row_id) > 1:
-            return tuple(existing_row_id)
-        elif len(existing_row_id) == 1:
-            return existing_row_id[0]
+        return self._pk_value([existing_row[x] for x in self.primary_keys])
+
+    def _rows_added(self, count):
+        # Keep count_cache current, count is negative for deleted rows and
+        # None when it isn't known
+        if self.count_cache is not None:
+            self.count_cache.adjust(count)
+
+    def _queue_writes(self):
+        # True if this write should be handed to write_queue, false on the
+        # writer thread itself which runs it
+        write_queue = self.write_queue
+        if write_queue is None or write_queue.in_writer():
+            return False
+        db = self.database()
+        if self._checked_write_queue is not write_queue:
+            # On another database the writes would run outside the
+            # writer's transaction, like bind() checks for transactions
+            if write_queue.database().pool is not db.pool:
+                raise ValueError(f'{self.table_name} is not in the write queue\'s database')
+            self._checked_write_queue = write_queue
+        # Inside a `with Database` block or with uncommitted writes this
+        # thread can hold the lock the writer would wait on until
+        # busy_timeout, run the write inline as part of its transaction
+        return db.pool.depth() == 0 and not db.conn.in_transaction
+
+    def _upsert_record(self, columns, values):
+        # create_record in one statement with ON CONFLICT ... RETURNING
+        set_columns = tuple(self.primary_keys[:1]) if self.upsert == 'update' else ()
+        sql = compile_statement(
+            'upsert', self.table_name, columns, set_columns=set_columns,
+            returning=tuple(self.primary_keys))
+        logging.debug(sql)
+        with self.database() as db:
+            try:
+                returned = db.query(sql, values)
+            except sqlite3.IntegrityError as e:
+                # Not a uniqueness conflict (NOT NULL, CHECK, ...), the
+                # existing row lookup below comes up empty like it used to
+                returned = []
+            if len(returned) > 0:
+                # DO UPDATE returns existing rows too
+                self._rows_added(1 if self.upsert == 'nothing' else None)
+                return self._pk_value(list(returned[0]))
+            logging.debug('Row already exists')
+            sql = compile_statement('select', self.table_name, columns)
+            logging.debug(sql)
+            existing_row = db.query(sql, values)[0]
+        return self._pk_value([existing_row[x] for x in self.primary_keys])
+
+    @traced
+    def create_records(self, rows, batch_size=DEFAULT_BATCH_SIZE):
+        # rows is any iterable of dicts of col=val
+        # Returns list of row_id/pk in the same order as rows, with the
+        # existing row_id/pk for rows that violate a unique constraint
+        # just like create_record
+        pks = []
+        batch = []
+        for row in rows:
+            batch.append({col: val for col, val in row.items() if val is not None})
+            if len(batch) >= batch_size:
+                pks.extend(self._insert_batch(batch))
+                batch = []
+        if len(batch) > 0:
+            pks.extend(self._insert_batch(batch))
+        return pks
+
+    def _insert_batch(self, batch):
+        # Rows are grouped by their set of columns so each group is a single
+        # executemany of one INSERT statement, committed together
+        groups = {}
+        for n, row in enumerate(batch):
+            self.check_column_args(row.keys())
+            groups.setdefault(tuple(sorted(row.keys())), []).append(n)
+
+        pks = [None] * len(batch)
+        added = 0
+        with self.database() as db:
+            for columns, positions in groups.items():
+                sql = compile_statement('insert', self.table_name, columns)
+                logging.debug(f'{sql} x {len(positions)}')
+                params = [tuple(batch[n][col] for col in columns) for n in positions]
+                if self._pks_derivable(columns) and db.insert_many(sql, params):
+                    added += len(params)
+                    inserted = self._pks_after_insert_many(db, columns, params)
+                    for n, pk in zip(positions, inserted):
+                        pks[n] = pk
+                    continue
+                # A row in the group already exists, or pks can't be derived
+                # from the batch so the group isn't inserted as one, go row
+                # by row on the same transaction
+                for n, values in zip(positions, params):
+                    pks[n], created = self._insert_one(db, sql, columns, values)
+                    added += created
+        self._rows_added(added)
+        return pks
+
+    def _pks_derivable(self, columns):
+        # True if the pks of rows inserted together by insert_many can be
+        # known without looking each row up, see _pks_after_insert_many
+        if self.primary_keys and all(pk in columns for pk in self.primary_keys):
+            return True
+        return (len(self.primary_keys) == 1
+                and self.columns[self.primary_keys[0]].type.upper() == 'INTEGER')
+
+    def _pks_after_insert_many(self, db, columns, params):
+        # Primary keys of rows just inserted by insert_many, only called
+        # when _pks_derivable(columns)
+        if all(pk in columns for pk in self.primary_keys):
+            positions = [columns.index(pk) for pk in self.primary_keys]
+            return [self._pk_value([values[i] for i in positions]) for values in params]
+        # pk is an alias of rowid and one transaction hands out consecutive
+        # rowids ending at last_insert_rowid()
+        last = db.query("SELECT last_insert_rowid()")[0][0]
+        return list(range(last - len(params) + 1, last + 1))
+
+    def _insert_one(self, db, sql, columns, values):
+        # Returns (pk, True if the row was created)
+        new_row_id = db.insert(sql, values)
+        if new_row_id is not None:
+            if self.primary_keys and all(pk in columns for pk in self.primary_keys):
+                return self._pk_value([values[columns.index(pk)] for pk in self.primary_keys]), True
+            return new_row_id, True
+        logging.debug('Row already exists')
+        sql = compile_statement('select', self.table_name, columns)
+        existing = db.query(sql, values)
+        if len(existing) == 0:
+            # NOT NULL, CHECK, or a unique conflict with a row that differs
+            # in other columns, there's no existing row to return
+            raise sqlite3.IntegrityError(
+                f'{self.table_name} row {dict(zip(columns, values))} violates a '
+                f'constraint and matches no existing row')
+        return self._pk_value([existing[0][x] for x in self.primary_keys]), False
 
-    def read_record(self, not_equal=False, **kwargs):
+    @staticmethod
+    def _pk_value(pk_values):
+        # Single pk comes back as the value, composite pk as a tuple
+        if len(pk_values) > 1:
+            return tuple(pk_values)
+        elif len(pk_values) == 1:
+            return pk_values[0]
+
+    @traced
+    def read_record(self, not_equal=False, columnar=False, order_by=None, limit=None,
+                    after=None, as_records=False, include=None, **kwargs):
         # return List[rows] or empty List if no rows
+        # or with columnar a dict of column name -> typed array
+        # or with as_records a List of this table's record class
+        # order_by is a column name or list of them, '-col' for descending
+        # With limit returns a Page of at most limit rows ordered by order_by
+        # then the primary keys, page.after is the token for the next one
+        # include is a list of parents (see include_parents) to load along,
+        # rows then come back as dicts with each parent's row added
+        if include:
+            if columnar or as_records:
+                raise ValueError('include needs plain rows, not columnar or records')
+            results = self.read_record(
+                not_equal=not_equal, order_by=order_by, limit=limit, after=after, **kwargs)
+            included = self.include_parents(results, include)
+            if isinstance(results, Page):
+                return Page(included, after=results.after)
+            return included
         columns, values = self.sanitize_kwargs(**kwargs)
-        repacked = dict(zip(columns, values))
-        col_val_pairs = self.column_equal_value(repacked, not_equal=not_equal)
-        sql = f"SELECT * FROM {self.table_name} WHERE {col_val_pairs}"
+        record_class = self.get_record_class() if as_records else None
+        if order_by is not None or limit is not None or after is not None:
+            return self._read_page(
+                columns, values, not_equal, columnar, order_by, limit, after, record_class)
+        sql = compile_statement('select', self.table_name, tuple(columns), not_equal)
+        logging.debug(sql)
+        if self.index_advisor is not None and not not_equal:
+            self.index_advisor.record(self, columns)
+        if columnar:
+            with self.database() as db:
+                return db.query(sql, values, columnar=True, types=self.column_types())
+        if (self.row_cache is not None and record_class is None and not not_equal
+                and self._is_pk_lookup(columns)):
+            return self._cached_read(sql, dict(zip(columns, values)))
+        with self.database() as db:
+            results = db.query(sql, values, record_class=record_class)
+        return results
+
+    def _read_page(self, columns, values, not_equal, columnar, order_by, limit, after,
+                   record_class=None):
+        # Keyset pagination: each page seeks past the last row of the one
+        # before with WHERE (order columns) > (its values), so every page
+        # costs the same however deep it is. NULLs in order_by columns are
+        # paged through in sqlite's order (first ascending, last
+        # descending), with a slower OR expanded seek when the last row
+        # has one or a descending column can hold them, see keyset_condition
+        if columnar and (limit is not None or after is not None):
+            raise ValueError('columnar results can not be paged')
+        order = self.order_keys(order_by, keyset=limit is not None or after is not None)
+        params = list(values)
+        state = False
+        if after is not None:
+            last = self.decode_token(after, len(order))
+            state = keyset_state(last, [self.nullable(col) for col, _ in order])
+            params.extend(keyset_params(order, last, state))
+        if limit is not None:
+            params.append(limit)
+        sql = compile_statement(
+            'select', self.table_name, tuple(columns), not_equal, order_by=order,
+            after=state, limit=limit is not None)
         logging.debug(sql)
-        with Database(self.db_file) as db:
-            results = db.query(sql)
+        if self.index_advisor is not None and not not_equal:
+            self.index_advisor.record(self, columns)
+        with self.database() as db:
+            if columnar:
+                return db.query(sql, params, columnar=True, types=self.column_types())
+            results = db.query(sql, params, record_class=record_class)
+        if limit is None:
+            return results
+        token = None
+        if len(results) == limit and limit > 0:
+            token = self.encode_token([results[-1][col] for col, _ in order])
+        return Page(results, after=token)
+
+    def include_parents(self, rows, include):
+        # Returns rows as dicts with the parent row each one references added
+        # for every name in include (None when it has no parent). A name is
+        # a parent table, or the child column of the foreign key when a
+        # table is referenced more than once. The parent row goes under the
+        # name, or name_row when that is a column (e.g. include='breed_id'
+        # adds 'breed_id_row'), so the rows can still be passed back to
+        # update_record/delete_record. Each parent costs one
+        # SELECT ... WHERE key IN (...) per chunk of distinct keys, however
+        # many rows there are
+        if isinstance(include, str):
+            include = [include]
+        results = [dict(row) for row in rows]
+        for name in include:
+            parent, from_columns, to_columns = self.parent_key(name)
+            keys = list(dict.fromkeys(
+                tuple(row[col] for col in from_columns) for row in results))
+            keys = [key for key in keys if None not in key]
+            by_key = {}
+            size = in_rows_chunk_size(MAX_VARIABLES, len(to_columns))
+            with self.database() as db:
+                for n in range(0, len(keys), size):
+                    chunk = pad_in_rows(keys[n:n + size])
+                    sql = compile_statement(
+                        'select', parent, tuple(to_columns), in_rows=len(chunk))
+                    logging.debug(sql)
+                    for parent_row in db.query(sql, [v for key in chunk for v in key]):
+                        by_key[tuple(parent_row[col] for col in to_columns)] = parent_row
+            key = f'{name}_row' if name in self.columns else name
+            for row in results:
+                row[key] = by_key.get(tuple(row[col] for col in from_columns))
+        return results
+
+    def parent_key(self, name):
+        # Returns (parent table, child columns, parent columns) of the
+        # foreign key include name refers to
+        fks = {}
+        for fk in self.parents:
+            fks.setdefault(fk['id'], []).append(fk)
+        matches = [
+            sorted(group, key=lambda fk: fk['seq']) for group in fks.values()
+            if group[0]['table'] == name or (len(group) == 1 and group[0]['from'] == name)
+        ]
+        if len(matches) == 0:
+            raise ValueError(f'{name} is not a parent of {self.table_name}')
+        if len(matches) > 1:
+            raise ValueError(
+                f'{self.table_name} references {name} more than once, '
+                f'include it by column instead')
+        group = matches[0]
+        parent = group[0]['table']
+        from_columns = [fk['from'] for fk in group]
+        to_columns = [fk['to'] for fk in group]
+        if None in to_columns:
+            # REFERENCES parent without columns means its primary key
+            to_columns = Table(parent, db_file=self.db_file, profile=self.profile).primary_keys
+        return parent, from_columns, to_columns
+
+    def order_keys(self, order_by, keyset=False):
+        # Parse order_by into a tuple of (column, descending). For keyset
+        # paging the primary keys are appended as tie breakers so the order
+        # is total, in the direction of the last order_by column
+        if order_by is None:
+            order_by = []
+        elif isinstance(order_by, str):
+            order_by = [order_by]
+        order = [(col.lstrip('-'), col.startswith('-')) for col in order_by]
+        self.check_column_args([col for col, _ in order])
+        if keyset:
+            if len(self.primary_keys) == 0:
+                raise ValueError(f'{self.table_name} has no primary key to page by')
+            desc = order[-1][1] if order else False
+            ordered = [col for col, _ in order]
+            order += [(pk, desc) for pk in self.primary_keys if pk not in ordered]
+        return tuple(order)
+
+    def nullable(self, column):
+        # False for NOT NULL columns and the INTEGER PRIMARY KEY rowid alias
+        if self.primary_keys == [column] and self.columns[column].type.upper() == 'INTEGER':
+            return False
+        return self.columns[column].nullable
+
+    @staticmethod
+    def encode_token(values):
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    @staticmethod
+    def decode_token(token, length):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(token.encode()))
+        except ValueError:
+            raise ValueError('invalid continuation token')
+        if not isinstance(values, list) or len(values) != length:
+            raise ValueError('continuation token does not match order_by')
+        return values
+
+    def _is_pk_lookup(self, columns):
+        return len(self.primary_keys) > 0 and set(columns) == set(self.primary_keys)
+
+    def _cached_read(self, sql, pk_values):
+        # read_record by primary key through row_cache
+        key = tuple(pk_values[pk] for pk in self.primary_keys)
+        with self.database() as db:
+            self.row_cache.check_data_version(db.conn)
+            results = self.row_cache.get(key)
+            if results is None:
+                results = db.query(sql, tuple(pk_values.values()))
+                if len(results) > 0:
+                    self.row_cache.put(key, results)
         return results
 
+    def iter_records(self, batch_size=DEFAULT_BATCH_SIZE, not_equal=False, as_records=False,
+                     **kwargs):
+        # Same rows as read_record but yielded one at a time from a live
+        # cursor so memory stays flat no matter how many rows match
+        columns, values = self.sanitize_kwargs(**kwargs)
+        sql = compile_statement('select', self.table_name, tuple(columns), not_equal)
+        logging.debug(sql)
+        record_class = self.get_record_class() if as_records else None
+        yield from self.database().iter_query(
+            sql, values, batch_size=batch_size, record_class=record_class)
+
+    def get_record_class(self):
+        # record_class generated by create_tables, or one built from columns
+        if self.record_class is None:
+            name = Database.underscore_to_camelcase(self.table_name) + 'Record'
+            self.record_class = make_record_class(name, self.columns.keys())
+        return self.record_class
+
+    @traced
     def update_record(self, rows, not_equal=False, **kwargs):
         # rows is set of rows to be updated
         # kwargs is col=val; col gets updated to val on $rows
-        # returns list of updated rows
+        # returns list of updated rows, straight from UPDATE ... RETURNING
+        # when sqlite supports it, else re-selected by the new values
         if rows is None:
             raise ValueError("rows is required argument")
+        if self._queue_writes():
+            return self.write_queue.update_record(self, rows, not_equal=not_equal, **kwargs).result()
 
         self.check_column_args(kwargs.keys())
-        col_val_pairs = self.column_equal_value(kwargs, not_equal=not_equal)
-        update_statements = [
-            (f"UPDATE {self.table_name} " 
-             f"SET {col_val_pairs} "
-             f"WHERE {pk}")
-            for pk in self.primary_keys_from_rows(rows)
-        ]
-        with Database(self.db_file) as db:
-            for statement in update_statements:
-                logging.debug(statement)
-                db.query(statement)
-        with Database(self.db_file) as db:
-            sql = f"SELECT * FROM {self.table_name} WHERE {col_val_pairs}"
-            logging.debug(sql)
-            updated_rows = db.query(sql)
+        set_columns = tuple(kwargs.keys())
+        set_values = tuple(kwargs.values())
+        updated_rows = []
+        with self.database() as db:
+            for chunk in self.primary_key_chunks(rows, reserved=len(set_values)):
+                sql = compile_statement(
+                    'update', self.table_name, tuple(self.primary_keys),
+                    set_columns=set_columns, in_rows=len(chunk),
+                    returning=SUPPORTS_RETURNING)
+                logging.debug(sql)
+                params = set_values + tuple(v for pk in chunk for v in pk)
+                updated_rows.extend(db.query(sql, params))
+        if self.row_cache is not None:
+            old_keys = self.primary_keys_from_rows(rows)
+            new_keys = [
+                tuple(kwargs.get(col, old[n]) for n, col in enumerate(self.primary_keys))
+                for old in old_keys
+            ]
+            self.row_cache.invalidate(old_keys + new_keys)
+        if SUPPORTS_RETURNING:
+            return updated_rows
+
+        sql = compile_statement('select', self.table_name, set_columns, not_equal)
+        logging.debug(sql)
+        with self.database() as db:
+            updated_rows = db.query(sql, set_values)
         return updated_rows
 
+    @traced
     def delete_record(self, rows):
         # rows is set of rows to be deleted
         # Returns number of rows deleted
         if rows is None:
             raise ValueError("rows is required argument")
+        if self._queue_writes():
+            return self.write_queue.delete_record(self, rows).result()
 
-        delete_statements = [
-            f"DELETE FROM {self.table_name} WHERE {pk}"
-            for pk in self.primary_keys_from_rows(rows)
-        ]
-        before_count = self.total_rows()
-        with Database(self.db_file) as db:
-            for statement in delete_statements:
-                logging.debug(statement)
-                db.query(statement)
-        after_count = self.total_rows()
-        row_delta = before_count - after_count
+        row_delta = 0
+        with self.database() as db:
+            for chunk in self.primary_key_chunks(rows):
+                sql = compile_statement(
+                    'delete', self.table_name, tuple(self.primary_keys),
+                    in_rows=len(chunk))
+                logging.debug(sql)
+                db.query(sql, tuple(v for pk in chunk for v in pk))
+                row_delta += db.cur.rowcount
+        if self.row_cache is not None:
+            self.row_cache.invalidate(self.primary_keys_from_rows(rows))
+        self._rows_added(-row_delta)
         return row_delta
 
     def check_column_args(self, column_args):
@@ -242,52 +857,118 @@ class Table:
         return True
 
     def sanitize_kwargs(self, **kwargs):
-        columns = list(kwargs.keys())
-        if self.check_column_args(columns):
-            values = list(kwargs.values())
-            for n, v in enumerate(values):
-                if v is None:
-                    del columns[n]
-                    del values[n]
+        # None values are left out, the column default applies instead
+        if self.check_column_args(kwargs.keys()):
+            columns = [col for col in kwargs if kwargs[col] is not None]
+            values = [kwargs[col] for col in columns]
             return columns, values
 
     def primary_keys_from_rows(self, rows):
-        pk_columns = [
-            column
-            for column in rows[0].keys()
-            if column in self.primary_keys
-        ]
-        pks = [row[column] for row in rows for column in pk_columns]
-        y = itertools.product(pk_columns, pks)
-        return [self.column_equal_value({z[0]: z[1]}) for z in y]
+        # Returns List[tuple] of primary key values in primary_keys order
+        return [tuple(row[column] for column in self.primary_keys) for row in rows]
+
+    def primary_key_chunks(self, rows, reserved=0):
+        # Split primary_keys_from_rows into chunks small enough to bind in
+        # one statement, leaving room for reserved other parameters. Chunks
+        # are padded with pad_in_rows to bound the number of statements
+        if len(self.primary_keys) == 0:
+            raise ValueError(f'{self.table_name} has no primary key')
+        pks = self.primary_keys_from_rows(rows)
+        size = in_rows_chunk_size(MAX_VARIABLES - reserved, len(self.primary_keys))
+        return [pad_in_rows(pks[n:n + size]) for n in range(0, len(pks), size)]
 
-    def total_rows(self):
+    @traced
+    def total_rows(self, approximate=False):
         # Count of every row in tables
-        with Database(self.db_file) as db:
+        # approximate answers from count_cache when there is one
+        if approximate and self.count_cache is not None:
+            return self.count_cache.get(self)
+        with self.database() as db:
             count = db.query(f"SELECT count(*) FROM {self.table_name}")
         return count.pop()['count(*)']
 
+    @traced
     def count_where(self, not_equal=False, **kwargs):
         # when not_equal: WHERE col!=val instead of col=val
-        if self.check_column_args(kwargs.keys()):
-            col_val_pairs = self.column_equal_value(kwargs, not_equal=not_equal)
-        sql = f"SELECT count(*) FROM {self.table_name} WHERE {col_val_pairs}"
+        self.check_column_args(kwargs.keys())
+        sql = compile_statement('count', self.table_name, tuple(kwargs.keys()), not_equal)
         logging.debug(sql)
-        with Database(self.db_file) as db:
-            count = db.query(sql)
+        if self.index_advisor is not None and not not_equal:
+            self.index_advisor.record(self, kwargs.keys())
+        with self.database() as db:
+            count = db.query(sql, tuple(kwargs.values()))
         return count.pop()['count(*)']
 
+    @traced
+    def aggregate(self, group_by=None, count=True, sum=None, min=None, max=None,
+                  not_equal=False, **kwargs):
+        # Returns List[rows] with a column per aggregate, one row per
+        # group_by group (or a single row without group_by), computed by
+        # sqlite instead of reading every row. Columns are named count,
+        # count_col when count is a column name, sum_col, min_col, max_col
+        # sum, min and max are a column name or list of them
+        group_by = self._column_list(group_by)
+        aggregates = []
+        if count is True:
+            aggregates.append(('count', '*'))
+        elif count:
+            aggregates.extend(('count', col) for col in self._column_list(count))
+        for func, columns in (('sum', sum), ('min', min), ('max', max)):
+            aggregates.extend((func, col) for col in self._column_list(columns))
+        if len(aggregates) == 0:
+            raise ValueError('aggregate needs count, sum, min or max')
+        self.check_column_args(
+            group_by + [col for _, col in aggregates if col != '*'] + list(kwargs))
+        sql = compile_statement(
+            'aggregate', self.table_name, tuple(kwargs.keys()), not_equal,
+            aggregates=tuple(aggregates), group_by=tuple(group_by))
+        logging.debug(sql)
+        if self.index_advisor is not None and not not_equal:
+            self.index_advisor.record(self, kwargs.keys())
+        with self.database() as db:
+            results = db.query(sql, tuple(kwargs.values()))
+        return results
+
+    @staticmethod
+    def _column_list(columns):
+        if columns is None:
+            return []
+        if isinstance(columns, str):
+            return [columns]
+        return list(columns)
+
+    @traced
     def sqlfile_query(self, sqlfile):
         # Load query from a sqlfile
-        with Database(self.db_file) as db:
+        # The file runs as a script, which can't be part of a transaction
+        # so a bound table raises ValueError, see Database.from_sqlfile
+        with self.database() as db:
             results = db.from_sqlfile(sqlfile)
         return results
 
-    def raw_query(self, sql):
-        with Database(self.db_file) as db:
-            results = db.query(sql)
+    @traced
+    def named_query(self, name, params=(), columnar=False):
+        # Unlike sqlfile_query the statement is kept in memory and run
+        # with bound parameters instead of re-read and run as a script
+        if self.queries is None:
+            raise ValueError(f'{self.__class__.__name__} has no queries registry')
+        sql = self.queries.sql(name)
+        with self.database() as db:
+            results = db.query(sql, params, columnar=columnar, types=self.column_types())
         return results
 
+    @traced
+    def raw_query(self, sql, columnar=False):
+        # columnar arrays are typed from this table's columns where the
+        # result column names match
+        with self.database() as db:
+            results = db.query(sql, columnar=columnar, types=self.column_types())
+        return results
+
+    def column_types(self):
+        # Column name -> declared type, used to type columnar results
+        return {name: col.type for name, col in self.columns.items()}
+
     def column_equal_value(self, col_val_pairs, not_equal=False):
         pairs = []
         for column in col_val_pairs:
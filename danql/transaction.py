@@ -0,0 +1,101 @@
+import threading
+
+from .database import Database
+
+# Transactions open in this thread, outermost first
+_local = threading.local()
+
+
+class Transaction:
+    """ One transaction shared by several Table operations
+
+    Everything run inside the block, on this thread, uses the same
+    connection and is committed once at the end, or rolled back as a whole
+    when the block raises:
+
+        with Database(db_file).transaction() as tx:
+            owner_id = owner_table.bind(tx).create_record(name='bobby')
+            dog_table.bind(tx).create_record(name='fido', owner_id=owner_id)
+
+    A transaction opened inside another one (or inside a `with Database`
+    block) is a SAVEPOINT, rolling it back undoes only its own writes and
+    the outermost block still decides whether anything is committed. Any
+    exception, KeyboardInterrupt included, rolls back.
+
+    Reads through bound tables can cache rows that are later rolled back,
+    and other threads can cache the old version of a row written inside
+    the transaction until it commits, which this thread's connection won't
+    see a data_version change for. So the row_cache and count_cache of
+    every table bound inside the outermost transaction are cleared on a
+    rollback and when the outermost transaction ends.
+    """
+
+    def __init__(self, db_file=None, profile=None):
+        self.db_file = db_file
+        self.profile = profile
+        self.db = None
+        self.savepoint = None
+        self.thread = None
+        self.caches = []
+
+    @property
+    def active(self):
+        return self.db is not None
+
+    def database(self):
+        # Database for sql run as part of this transaction
+        if not self.active:
+            raise RuntimeError('transaction is not active')
+        if threading.current_thread() is not self.thread:
+            raise RuntimeError('transaction belongs to another thread')
+        return Database(self.db_file, profile=self.profile)
+
+    def track(self, table):
+        # Caches of a table bound to this transaction, see Table.bind
+        for cache in (table.row_cache, table.count_cache):
+            if cache is not None and not any(cache is c for c in self.caches):
+                self.caches.append(cache)
+
+    def __enter__(self):
+        if self.active:
+            raise RuntimeError('transaction is already active')
+        db = Database(self.db_file, profile=self.profile).__enter__()
+        try:
+            if not db.conn.in_transaction:
+                db.cur.execute("BEGIN")
+            if db.pool.depth() > 1:
+                self.savepoint = f'danql_tx_{db.pool.depth()}'
+                db.cur.execute(f"SAVEPOINT {self.savepoint}")
+        except Exception as e:
+            db.__exit__(type(e), e, e.__traceback__)
+            raise
+        stack = _local.__dict__.setdefault('stack', [])
+        # nested transactions share the outermost one's caches
+        self.caches = stack[0].caches if stack else []
+        stack.append(self)
+        self.db = db
+        self.thread = threading.current_thread()
+        return self
+
+    def __exit__(self, ext_type, exc_value, traceback):
+        db = self.db
+        self.db = None
+        _local.stack.remove(self)
+        outermost = len(_local.stack) == 0
+        failed = exc_value is not None
+        try:
+            if self.savepoint is not None:
+                if failed:
+                    db.cur.execute(f"ROLLBACK TO {self.savepoint}")
+                db.cur.execute(f"RELEASE {self.savepoint}")
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.savepoint = None
+            # Database.__exit__ would commit on a BaseException
+            db.cur.close()
+            db.pool.end(commit=not failed)
+            if failed or outermost:
+                for cache in self.caches:
+                    cache.invalidate()
@@ -0,0 +1,152 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from .database import Database
+
+DEFAULT_GROUP_SIZE = 256
+DEFAULT_INTERVAL = 0.002  # seconds
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+class WriteQueue:
+    """ Background writer committing many callers' writes together
+
+    Any thread can submit writes, they are run by a single writer thread
+    which takes everything queued within interval seconds (at most
+    batch_size writes) and runs it in one transaction, so concurrent
+    writers share one commit and one fsync instead of taking turns on the
+    database lock. Every write runs in its own savepoint, one failing only
+    fails its own future. Futures are resolved once the transaction has
+    committed.
+
+        writes = get_write_queue('example.db')
+        future = writes.create_record(example_table, example_text='hi')
+        future.result()  # pk, exactly like example_table.create_record
+
+    Setting table.write_queue makes create_record, update_record and
+    delete_record go through the queue and wait for their result. The
+    queue has to be for the table's db_file and profile so the writes land
+    on the writer's connection and transaction.
+    """
+
+    def __init__(self, db_file=None, profile=None, batch_size=DEFAULT_GROUP_SIZE,
+                 interval=DEFAULT_INTERVAL):
+        self.db_file = db_file
+        self.profile = profile
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        # Run func(*args, **kwargs) on the writer thread, returns a Future
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('write queue is closed')
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name=f'danql-writer-{self.db_file}', daemon=True)
+                self._thread.start()
+            self._queue.put((future, func, args, kwargs))
+        return future
+
+    def create_record(self, table, **kwargs):
+        return self.submit(table.create_record, **kwargs)
+
+    def update_record(self, table, rows, not_equal=False, **kwargs):
+        return self.submit(table.update_record, rows, not_equal=not_equal, **kwargs)
+
+    def delete_record(self, table, rows):
+        return self.submit(table.delete_record, rows)
+
+    def database(self):
+        # Database the writes run on
+        return Database(self.db_file, profile=self.profile)
+
+    def in_writer(self):
+        return threading.current_thread() is self._thread
+
+    def close(self, wait=True):
+        # Write what is queued and stop the writer thread
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(None)
+        if wait and thread is not None:
+            thread.join()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._write(batch)
+
+    def _write(self, batch):
+        # Nested `with Database` blocks in the table methods share this
+        # one's connection and transaction, see pool.ConnectionPool
+        done = []
+        try:
+            with self.database() as db:
+                if not db.conn.in_transaction:
+                    db.cur.execute("BEGIN")
+                for future, func, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    db.cur.execute("SAVEPOINT write_queue")
+                    try:
+                        result = func(*args, **kwargs)
+                    except Exception as e:
+                        db.cur.execute("ROLLBACK TO write_queue")
+                        db.cur.execute("RELEASE write_queue")
+                        done.append((future, None, e))
+                        continue
+                    db.cur.execute("RELEASE write_queue")
+                    done.append((future, result, None))
+        except Exception as e:
+            # The transaction didn't commit, nothing in it was written
+            for future, _, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result, error in done:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+def get_write_queue(db_file=None, profile=None, **options):
+    # Return the process wide WriteQueue for db_file and profile
+    key = (db_file, profile)
+    with _queues_lock:
+        write_queue = _queues.get(key)
+        if write_queue is None or write_queue._closed:
+            write_queue = WriteQueue(db_file, profile=profile, **options)
+            _queues[key] = write_queue
+    return write_queue
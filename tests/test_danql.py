@@ -1,10 +1,18 @@
+import asyncio
 import glob
 import os
+import sqlite3
 import sys
+import threading
 import unittest
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from danql import Database
+from danql import (
+    AsyncDatabase, AsyncTable, BackupSchedule, Database, IndexAdvisor, QueryRegistry, RowCache,
+    RowCount, SlowQueryLog, StatementStats, Table, WriteQueue, close_all, instrumentation,
+    schema_cache)
+from danql.record import make_record_class
+from danql.table import compile_statement
 
 class TestDanql(unittest.TestCase):
     db_file = 'tests/test.db'
@@ -34,6 +42,35 @@ class TestDanql(unittest.TestCase):
         gs_id2 = self.Breed.create_record(name='german shepherd')
         self.assertEqual(gs_id1, gs_id2)
 
+    def test_upsert_modes(self):
+        gs_id = self.Breed.create_record(name='german shepherd')
+        cbf_id = self.Owner.create_record(name='chef bobby flay')
+        for upsert in ('nothing', 'update', None):
+            self.Breed.upsert = upsert
+            self.Dog.upsert = upsert
+            try:
+                self.assertEqual(self.Breed.create_record(name='german shepherd'), gs_id)
+                fido = self.Dog.create_record(breed_id=gs_id, owner_id=cbf_id, name='fido')
+                fido2 = self.Dog.create_record(breed_id=gs_id, owner_id=cbf_id, name='fido')
+                self.assertEqual(fido2, (gs_id, cbf_id, 'fido'))
+            finally:
+                self.Breed.upsert = 'nothing'
+                self.Dog.upsert = 'nothing'
+        self.assertEqual(self.Breed.total_rows(), 1)
+        self.assertEqual(self.Dog.total_rows(), 1)
+
+    def test_upsert_update_leaves_existing_row(self):
+        with Database(self.db_file) as db:
+            db.query("CREATE TABLE person (id INTEGER PRIMARY KEY, name TEXT, email TEXT UNIQUE)")
+        try:
+            person = Table('person', db_file=self.db_file, upsert='update')
+            alice = person.create_record(name='alice', email='x@y')
+            self.assertEqual(person.create_record(name='mallory', email='x@y'), alice)
+            self.assertEqual(person.read_record(id=alice)[0]['name'], 'alice')
+        finally:
+            with Database(self.db_file) as db:
+                db.query("DROP TABLE person")
+
     def test_total_rows(self):
         before = self.Breed.total_rows()
         self.assertEqual(before, 0)
@@ -46,6 +83,364 @@ class TestDanql(unittest.TestCase):
         _is = self.Dog.column_equal_value(col_val_pairs)
         _not = self.Dog.column_equal_value(col_val_pairs, not_equal=True)
 
+    def test_iter_records(self):
+        names = [f'breed {n}' for n in range(10)]
+        self.Breed.create_records([dict(name=n) for n in names])
+        streamed = [row['name'] for row in self.Breed.iter_records(batch_size=3)]
+        self.assertEqual(sorted(streamed), sorted(names))
+        rows = self.Breed.iter_records(batch_size=3, name='breed 1')
+        self.assertEqual(next(rows)['name'], 'breed 1')
+        rows.close()
+        self.Breed.create_record(name='breed 10')
+        self.assertEqual(self.Breed.total_rows(), 11)
+
+    def test_row_cache(self):
+        self.Breed.row_cache = RowCache(maxsize=2)
+        try:
+            gs_id = self.Breed.create_record(name='german shepherd')
+            self.Breed.read_record(breed_id=gs_id)
+            self.assertEqual(self.Breed.read_record(breed_id=gs_id)[0]['name'], 'german shepherd')
+            self.assertEqual(self.Breed.row_cache.stats()['hits'], 1)
+            self.Breed.update_record(rows=self.Breed.read_record(breed_id=gs_id), name='pug')
+            self.assertEqual(self.Breed.read_record(breed_id=gs_id)[0]['name'], 'pug')
+            # a commit from another connection clears the cache
+            other = threading.Thread(target=lambda: self.Breed.raw_query(
+                f"UPDATE breed SET name='beagle' WHERE breed_id={gs_id}"))
+            other.start()
+            other.join()
+            self.assertEqual(self.Breed.read_record(breed_id=gs_id)[0]['name'], 'beagle')
+            self.Breed.delete_record(rows=self.Breed.read_record(breed_id=gs_id))
+            self.assertEqual(self.Breed.read_record(breed_id=gs_id), [])
+        finally:
+            self.Breed.row_cache = None
+
+    def test_columnar_results(self):
+        gs_id = self.Breed.create_record(name='german shepherd')
+        pug_id = self.Breed.create_record(name='pug')
+        cols = self.Breed.read_record(columnar=True)
+        self.assertEqual(list(cols['breed_id']), [gs_id, pug_id])
+        self.assertEqual(list(cols['name']), ['german shepherd', 'pug'])
+        cols = self.Breed.raw_query("SELECT count(*) AS n FROM breed WHERE name='none'", columnar=True)
+        self.assertEqual(list(cols['n']), [0])
+        cols = self.Breed.read_record(columnar=True, name='none')
+        self.assertEqual(len(cols['breed_id']), 0)
+        self.assertEqual(self.Breed.raw_query("DELETE FROM breed WHERE 0", columnar=True), {})
+
+    def test_keyset_pagination(self):
+        names = ['pug', 'beagle', 'poodle', 'akita', 'boxer']
+        self.Breed.create_records([dict(name=n) for n in names])
+        for order_by, expected in (('name', sorted(names)), ('-name', sorted(names, reverse=True))):
+            seen = []
+            page = self.Breed.read_record(order_by=order_by, limit=2)
+            while True:
+                seen.extend(row['name'] for row in page)
+                if page.after is None:
+                    break
+                page = self.Breed.read_record(order_by=order_by, limit=2, after=page.after)
+            self.assertEqual(seen, expected)
+        gs_id = self.Breed.create_record(name='german shepherd')
+        cbf_id = self.Owner.create_record(name='chef bobby flay')
+        self.Dog.create_records([dict(breed_id=gs_id, owner_id=cbf_id, name=n) for n in names])
+        page = self.Dog.read_record(order_by=['owner_id', '-name'], limit=3, breed_id=gs_id)
+        page = self.Dog.read_record(
+            order_by=['owner_id', '-name'], limit=3, after=page.after, breed_id=gs_id)
+        self.assertEqual([row['name'] for row in page], ['beagle', 'akita'])
+        self.assertIsNone(page.after)
+        with self.assertRaises(ValueError):
+            self.Dog.read_record(order_by='name', limit=3, after=page.after or 'bad')
+
+    def test_keyset_pagination_nulls(self):
+        with Database(self.db_file) as db:
+            db.query("CREATE TABLE grouped (id INTEGER PRIMARY KEY, grp INTEGER)")
+        try:
+            grouped = Table('grouped', db_file=self.db_file)
+            grouped.create_records(
+                [dict(id=n, grp=None if n <= 3 else n % 3) for n in range(1, 9)])
+            for order_by in ('grp', '-grp', ['grp', '-id'], ['-grp', 'id']):
+                expected = [row['grp'] for row in grouped.read_record(order_by=order_by)]
+                seen = []
+                page = grouped.read_record(order_by=order_by, limit=2)
+                while True:
+                    seen.extend(page)
+                    if page.after is None:
+                        break
+                    page = grouped.read_record(order_by=order_by, limit=2, after=page.after)
+                self.assertEqual(sorted(row['id'] for row in seen), list(range(1, 9)))
+                self.assertEqual([row['grp'] for row in seen], expected)
+        finally:
+            with Database(self.db_file) as db:
+                db.query("DROP TABLE grouped")
+
+    def test_record_classes(self):
+        gs_id = self.Breed.create_record(name='german shepherd')
+        cbf_id = self.Owner.create_record(name='chef bobby flay')
+        self.Dog.create_records([dict(breed_id=gs_id, owner_id=cbf_id, name=n) for n in ('fido', 'rex')])
+        self.assertEqual(self.Dog.record_class.__name__, 'DogRecord')
+        dogs = self.Dog.read_record(as_records=True, breed_id=gs_id)
+        self.assertEqual(dogs, [self.Dog.record_class(gs_id, cbf_id, 'fido'),
+                                self.Dog.record_class(gs_id, cbf_id, 'rex')])
+        self.assertFalse(hasattr(dogs[0], '__dict__'))
+        self.assertEqual((dogs[0].name, dogs[0]['owner_id'], dogs[0][0]), ('fido', cbf_id, gs_id))
+        self.assertEqual(self.Dog.delete_record(rows=dogs[:1]), 1)
+        with Database(self.db_file) as db:
+            names = db.query("SELECT name, breed_id FROM dog", record_class=self.Dog.record_class)
+        self.assertEqual(names[0].as_dict(), dict(breed_id=gs_id, owner_id=None, name='rex'))
+        streamed = list(self.Dog.iter_records(as_records=True))
+        self.assertEqual(streamed[0].name, 'rex')
+        for columns in (['id', 'self'], ['id', 'keys'], ['row_factory', 'as_dict']):
+            definition = Database.class_definition_from_table_name('odd', columns)
+            compile(definition, 'odd.py', 'exec')
+            self.assertNotIn('OddRecord', definition)
+            with self.assertRaises(ValueError):
+                make_record_class('OddRecord', columns)
+
+    def test_include_parents(self):
+        gs_id = self.Breed.create_record(name='german shepherd')
+        pug_id = self.Breed.create_record(name='pug')
+        cbf_id = self.Owner.create_record(name='chef bobby flay')
+        self.Dog.create_records([
+            dict(breed_id=gs_id, owner_id=cbf_id, name='fido'),
+            dict(breed_id=pug_id, owner_id=cbf_id, name='rex'),
+            dict(breed_id=gs_id, owner_id=cbf_id, name='spot')])
+        events = []
+        hook = instrumentation.add_hook(post=events.append)
+        try:
+            dogs = self.Dog.read_record(include=['owner', 'breed'], owner_id=cbf_id)
+        finally:
+            instrumentation.remove_hook(hook)
+        self.assertEqual(len(events), 3)
+        self.assertEqual(
+            sorted((d['name'], d['breed']['name'], d['owner']['name']) for d in dogs),
+            [('fido', 'german shepherd', 'chef bobby flay'),
+             ('rex', 'pug', 'chef bobby flay'),
+             ('spot', 'german shepherd', 'chef bobby flay')])
+        page = self.Dog.read_record(include='breed_id', order_by='name', limit=2)
+        self.assertEqual([d['breed_id_row']['name'] for d in page], ['german shepherd', 'pug'])
+        self.assertIsNotNone(page.after)
+        self.assertEqual(self.Dog.delete_record(page), 2)
+        with self.assertRaises(ValueError):
+            self.Dog.read_record(include=['cat'])
+
+    def test_backup(self):
+        self.Breed.create_records([dict(name=f'breed {n}') for n in range(50)])
+        target = os.path.join(self.out_dir, 'backup.db')
+        steps = []
+        with Database(self.db_file) as db:
+            db.backup(target, pages=1, sleep=0, progress=lambda *args: steps.append(args))
+        self.assertGreater(len(steps), 1)
+        self.assertEqual(steps[-1][1], 0)  # no pages remaining
+        with sqlite3.connect(target) as conn:
+            self.assertEqual(conn.execute("SELECT count(*) FROM breed").fetchone()[0], 50)
+        schedule = BackupSchedule(self.db_file, os.path.join(self.out_dir, 'sched-%S.db'), interval=60)
+        self.assertTrue(schedule.run_once())
+        self.assertTrue(os.path.exists(schedule.last))
+        self.assertFalse(os.path.exists(target + '.partial'))
+
+    def test_named_query(self):
+        queries = QueryRegistry('tests/sql', check_interval=0)
+        self.assertIn('get_breeds', queries.names())
+        self.Breed.create_record(name='pug')
+        path = os.path.join(self.out_dir, 'queries')
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'breeds.sql'), 'w') as f:
+            f.write("-- name: breed_by_name\nSELECT * FROM breed WHERE name = :name;\n"
+                    "-- name: breed_count\nSELECT count(*) FROM breed\n")
+        queries = QueryRegistry(path, check_interval=0)
+        self.Breed.queries = queries
+        try:
+            self.assertEqual(self.Breed.named_query('breed_by_name', {'name': 'pug'})[0]['name'], 'pug')
+            self.assertEqual(queries.query('breed_count', db_file=self.db_file)[0][0], 1)
+            with open(os.path.join(path, 'breeds.sql'), 'w') as f:
+                f.write("-- name: breed_names\nSELECT name FROM breed\n")
+            os.utime(os.path.join(path, 'breeds.sql'), ns=(0, 0))
+            self.assertEqual(queries.names(), ['breed_names'])
+        finally:
+            self.Breed.queries = None
+
+    def test_transaction(self):
+        db = Database(self.db_file)
+        with self.assertRaises(ValueError):
+            with db.transaction() as tx:
+                self.Owner.bind(tx).create_record(name='chef bobby flay')
+                self.Dog.bind(tx).create_record(bad_column='fido')
+        self.assertEqual(self.Owner.total_rows(), 0)
+        with db.transaction() as tx:
+            owner = self.Owner.bind(tx)
+            cbf_id = owner.create_record(name='chef bobby flay')
+            try:
+                with db.transaction() as inner:
+                    owner.bind(inner).create_record(name='gordon ramsay')
+                    raise KeyError
+            except KeyError:
+                pass
+            breed_id = self.Breed.bind(tx).create_record(name='pug')
+            self.Dog.bind(tx).create_record(name='fido', owner_id=cbf_id, breed_id=breed_id)
+            self.assertTrue(tx.db.conn.in_transaction)
+        self.assertEqual([r['name'] for r in self.Owner.read_record()], ['chef bobby flay'])
+        self.assertEqual(self.Dog.count_where(owner_id=cbf_id), 1)
+        with self.assertRaises(RuntimeError):
+            self.Owner.bind(tx).read_record()
+
+    def test_async(self):
+        async def main():
+            async with AsyncDatabase(self.db_file) as adb:
+                breeds = AsyncTable(adb, self.Breed)
+                pug_id = await breeds.create_record(name='pug')
+                await breeds.create_records([dict(name=f'breed {n}') for n in range(25)])
+                self.assertEqual((await breeds.read_record(breed_id=pug_id))[0]['name'], 'pug')
+                names = [row['name'] async for row in breeds.iter_records(batch_size=4)]
+                self.assertEqual(len(names), 26)
+                async for row in adb.iter_query("SELECT * FROM breed", batch_size=2):
+                    break
+                forever = ("WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) "
+                           "SELECT count(*) FROM c")
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(adb.query(forever), 0.1)
+                self.assertEqual(await breeds.total_rows(), 26)
+                # writes between batches of a stream on the single thread
+                async for row in breeds.iter_records(batch_size=4):
+                    await asyncio.wait_for(breeds.update_record([row], name=row['name'] + '!'), 5)
+                self.assertEqual(len(await breeds.read_record(name='pug!')), 1)
+                with self.assertRaises(ValueError):
+                    AsyncTable(adb, Table('breed', db_file=self.db_file, profile='throughput'))
+        asyncio.run(main())
+
+    def test_async_wal_streams(self):
+        db_file = os.path.join(self.out_dir, 'wal.db')
+        with Database(db_file, profile='throughput') as db:
+            db.query("CREATE TABLE n (v INTEGER)")
+            db.insert_many("INSERT INTO n (v) VALUES (?)", [(v,) for v in range(10)])
+
+        threads = set()
+
+        async def total(adb):
+            values = []
+            async for row in adb.iter_query("SELECT v FROM n", batch_size=3):
+                values.append(row['v'])
+                threads.update(t for t in threading.enumerate() if t.name.startswith('danql-stream'))
+            return sum(values)
+
+        async def main():
+            async with AsyncDatabase(db_file, profile='throughput', readers=2) as adb:
+                self.assertTrue(adb.wal)
+                self.assertEqual(await asyncio.gather(*[total(adb) for _ in range(6)]), [45] * 6)
+            self.assertLessEqual(len(threads), 2)
+        asyncio.run(main())
+
+    def test_async_is_read(self):
+        from danql.aio import is_read
+        self.assertTrue(is_read("WITH b AS (SELECT * FROM breed) SELECT * FROM b"))
+        self.assertFalse(is_read("WITH b AS (SELECT 1) DELETE FROM breed"))
+        self.assertTrue(is_read("PRAGMA table_info(breed)"))
+        self.assertTrue(is_read("pragma journal_mode"))
+        self.assertFalse(is_read("PRAGMA journal_mode=WAL"))
+        self.assertFalse(is_read("PRAGMA journal_mode(WAL)"))
+        self.assertFalse(is_read("PRAGMA optimize"))
+        self.assertFalse(is_read("UPDATE breed SET name = 'x'"))
+
+    def test_aggregate(self):
+        gs_id = self.Breed.create_record(name='german shepherd')
+        pug_id = self.Breed.create_record(name='pug')
+        cbf_id = self.Owner.create_record(name='chef bobby flay')
+        self.Dog.create_records([
+            dict(breed_id=gs_id, owner_id=cbf_id, name='fido'),
+            dict(breed_id=pug_id, owner_id=cbf_id, name='rex'),
+            dict(breed_id=gs_id, owner_id=cbf_id, name='spot')])
+        groups = self.Dog.aggregate(group_by='breed_id', max='name', owner_id=cbf_id)
+        self.assertEqual(
+            sorted(tuple(row) for row in groups), sorted([(gs_id, 2, 'spot'), (pug_id, 1, 'rex')]))
+        total = self.Breed.aggregate(count=False, sum='breed_id', min=['breed_id', 'name'])[0]
+        self.assertEqual(
+            (total['sum_breed_id'], total['min_breed_id'], total['min_name']),
+            (gs_id + pug_id, min(gs_id, pug_id), 'german shepherd'))
+        with self.assertRaises(ValueError):
+            self.Dog.aggregate(sum='cat')
+
+    def test_approximate_total_rows(self):
+        self.Breed.count_cache = RowCount()
+        try:
+            self.Breed.create_record(name='pug')
+            self.assertEqual(self.Breed.total_rows(approximate=True), 1)
+            events = []
+            hook = instrumentation.add_hook(post=events.append)
+            try:
+                self.Breed.create_record(name='pug')
+                self.Breed.create_records([dict(name='pug'), dict(name='boxer'), dict(name='husky')])
+                self.assertEqual(self.Breed.total_rows(approximate=True), 3)
+                self.Breed.delete_record(self.Breed.read_record(name='boxer'))
+                self.assertEqual(self.Breed.total_rows(approximate=True), 2)
+            finally:
+                instrumentation.remove_hook(hook)
+            self.assertFalse(any('count(*)' in e['sql'] for e in events))
+            self.assertEqual(self.Breed.total_rows(), 2)
+        finally:
+            self.Breed.count_cache = None
+
+    def test_open_transaction_ends_with_next_block(self):
+        # a Database used without `with` shares the thread's connection, the
+        # next block to end commits or rolls back its writes
+        db = Database(self.db_file)
+        db.query("INSERT INTO breed (name) VALUES ('pug')")
+        with self.assertRaises(ValueError):
+            with Database(self.db_file):
+                raise ValueError
+        self.assertEqual(self.Breed.total_rows(), 0)
+        db.query("INSERT INTO breed (name) VALUES ('pug')")
+        self.assertEqual(self.Owner.read_record(), [])
+        self.assertFalse(db.conn.in_transaction)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.Breed.total_rows()))
+        thread.start()
+        thread.join()
+        self.assertEqual(other, [1])
+
+    def test_transaction_rollback_clears_caches(self):
+        self.Breed.row_cache = RowCache()
+        try:
+            pug_id = self.Breed.create_record(name='pug')
+            db = Database(self.db_file)
+            with self.assertRaises(KeyError):
+                with db.transaction() as tx:
+                    breed = self.Breed.bind(tx)
+                    breed.update_record(breed.read_record(breed_id=pug_id), name='boxer')
+                    self.assertEqual(breed.read_record(breed_id=pug_id)[0]['name'], 'boxer')
+                    raise KeyError
+            self.assertEqual(self.Breed.read_record(breed_id=pug_id)[0]['name'], 'pug')
+        finally:
+            self.Breed.row_cache = None
+
+    def test_transaction_commit_clears_caches(self):
+        self.Breed.row_cache = RowCache()
+        try:
+            pug_id = self.Breed.create_record(name='pug')
+            with Database(self.db_file).transaction() as tx:
+                breed = self.Breed.bind(tx)
+                breed.update_record(breed.read_record(breed_id=pug_id), name='boxer')
+                # another thread caches the committed row before this commits
+                other = threading.Thread(target=self.Breed.read_record, kwargs={'breed_id': pug_id})
+                other.start()
+                other.join()
+            self.assertEqual(self.Breed.read_record(breed_id=pug_id)[0]['name'], 'boxer')
+        finally:
+            self.Breed.row_cache = None
+
+    def test_transaction_rolls_back_on_base_exception(self):
+        with self.assertRaises(KeyboardInterrupt):
+            with Database(self.db_file).transaction() as tx:
+                self.Owner.bind(tx).create_record(name='chef bobby flay')
+                raise KeyboardInterrupt
+        self.assertEqual(self.Owner.total_rows(), 0)
+
+    def test_sqlfile_query_in_transaction(self):
+        with self.assertRaises(KeyError):
+            with Database(self.db_file).transaction() as tx:
+                breed = self.Breed.bind(tx)
+                breed.create_record(name='pug')
+                with self.assertRaises(ValueError):
+                    breed.sqlfile_query(sqlfile='tests/sql/get_breeds.sql')
+                raise KeyError
+        self.assertEqual(self.Breed.total_rows(), 0)
+
     def test_update_record(self):
         self.Breed.create_record(name='german shepherd')
         rows = self.Breed.read_record(name='german shepherd')
@@ -58,6 +453,23 @@ class TestDanql(unittest.TestCase):
         deleted = self.Breed.delete_record(rows=rows)
         self.assertEqual(deleted, 1)
 
+    def test_update_and_delete_composite_primary_key(self):
+        gs_id = self.Breed.create_record(name='german shepherd')
+        cbf_id = self.Owner.create_record(name='chef bobby flay')
+        self.Dog.create_records([
+            dict(breed_id=gs_id, owner_id=cbf_id, name=n) for n in ('fido', 'rex', 'spot')])
+        rows = self.Dog.read_record(name='fido') + self.Dog.read_record(name='rex')
+        updated = self.Dog.update_record(rows=rows, owner_id=cbf_id)
+        self.assertEqual(sorted(r['name'] for r in updated), ['fido', 'rex'])
+        self.assertEqual(self.Dog.delete_record(rows=rows), 2)
+        self.assertEqual(self.Dog.total_rows(), 1)
+        self.assertEqual(self.Dog.delete_record(rows=[]), 0)
+        sql = compile_statement('delete', 'dog', tuple(self.Dog.primary_keys), in_rows=2)
+        with Database(self.db_file) as db:
+            plan = [row['detail'] for row in db.query(f"EXPLAIN QUERY PLAN {sql}", [0] * 6)]
+        self.assertTrue(any(d.startswith('SEARCH dog USING') for d in plan), plan)
+        self.assertNotIn('SCAN dog', plan)
+
     def test_composite_primary_key(self):
         gs_id = self.Breed.create_record(name='german shepherd')
         cbf_id = self.Owner.create_record(name='chef bobby flay')
@@ -70,6 +482,22 @@ class TestDanql(unittest.TestCase):
         sql_injection = self.Breed.create_record(name='DROP TABLE breed;')
         self.Breed.read_record(name='german shepherd')
 
+    def test_quotes_are_not_stripped(self):
+        name = "o'malley's \"terrier\""
+        pk = self.Breed.create_record(name=name)
+        self.assertEqual(self.Breed.read_record(name=name)[0]['name'], name)
+        self.assertEqual(self.Breed.create_record(name=name), pk)
+
+    def test_compile_statement_is_cached(self):
+        compile_statement.cache_clear()
+        self.Breed.read_record(name='pug')
+        self.Breed.read_record(name='poodle')
+        info = compile_statement.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+        self.assertEqual(
+            compile_statement('select', 'breed', ('name',)),
+            "SELECT * FROM breed WHERE name=?")
+
     def test_sqlfile_query(self):
         self.Breed.create_record(name='german shepherd')
         results = self.Breed.sqlfile_query(sqlfile='tests/sql/get_breeds.sql')
@@ -77,5 +505,231 @@ class TestDanql(unittest.TestCase):
     def test_raw_query(self):
         self.Breed.raw_query("SELECT * FROM breed")
 
+    def test_create_records(self):
+        existing = self.Breed.create_record(name='poodle')
+        names = ['pug', 'poodle', 'beagle', 'pug']
+        pks = self.Breed.create_records([dict(name=n) for n in names], batch_size=3)
+        self.assertEqual(pks[1], existing)
+        self.assertEqual(pks[0], pks[3])
+        for name, pk in zip(names, pks):
+            self.assertEqual(self.Breed.read_record(name=name)[0]['breed_id'], pk)
+        self.assertEqual(self.Breed.total_rows(), 3)
+
+    def test_create_records_composite_primary_key(self):
+        gs_id = self.Breed.create_record(name='german shepherd')
+        cbf_id = self.Owner.create_record(name='chef bobby flay')
+        rows = [dict(breed_id=gs_id, owner_id=cbf_id, name=n) for n in ('fido', 'rex', 'fido')]
+        pks = self.Dog.create_records(rows)
+        self.assertEqual(pks, [(gs_id, cbf_id, 'fido'), (gs_id, cbf_id, 'rex'), (gs_id, cbf_id, 'fido')])
+
+    def test_create_records_without_integer_primary_key(self):
+        with Database(self.db_file) as db:
+            db.query("CREATE TABLE tag (a, b)")
+            db.query("CREATE TABLE label (id BIGINT PRIMARY KEY, v TEXT UNIQUE)")
+        try:
+            tag = Table('tag', db_file=self.db_file)
+            self.assertEqual(len(tag.create_records([dict(a=1, b=2), dict(a=3)])), 2)
+            self.assertEqual(tag.total_rows(), 2)
+            label = Table('label', db_file=self.db_file)
+            label.create_records([dict(v='a'), dict(v='b'), dict(v='a')])
+            self.assertEqual(label.total_rows(), 2)
+        finally:
+            with Database(self.db_file) as db:
+                db.query("DROP TABLE tag")
+                db.query("DROP TABLE label")
+
+    def test_in_list_statement_shapes(self):
+        self.Owner.create_records([dict(name=f'owner {n}') for n in range(33)])
+        owners = self.Owner.read_record()
+        events = []
+        hook = instrumentation.add_hook(post=events.append)
+        try:
+            for n in range(1, 34):
+                self.assertEqual(len(self.Owner.update_record(owners[:n], name='renamed')), n)
+        finally:
+            instrumentation.remove_hook(hook)
+        self.assertEqual(len(set(e['sql'] for e in events)), 7)  # 1, 2, 4 ... 64
+        self.assertEqual(self.Owner.delete_record(owners[:3]), 3)
+
+    def test_create_records_constraint_violation(self):
+        rows = [dict(breed_id=1, owner_id=1, name='fido'), dict(owner_id=1, name='no breed')]
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.Dog.create_records(rows)
+        self.assertEqual(self.Dog.total_rows(), 0)
+
+    def test_schema_cache(self):
+        schema_cache.warm(self.db_file)
+        self.assertEqual(self.Dog.schema()['parents'], schema_cache.table(self.db_file, 'dog')['parents'])
+        self.assertEqual(self.Dog.primary_keys, ['breed_id', 'owner_id', 'name'])
+        self.assertEqual(self.Dog.foreign_keys, {'breed_id', 'owner_id'})
+        self.assertIn('name', self.Breed.indexes)
+        with Database(self.db_file) as db:
+            db.query("CREATE TABLE IF NOT EXISTS cat (cat_id INTEGER PRIMARY KEY)")
+        try:
+            self.assertIn('cat_id', schema_cache.table(self.db_file, 'cat')['table_info'][0]['name'])
+        finally:
+            with Database(self.db_file) as db:
+                db.query("DROP TABLE cat")
+
+    def test_schema_cache_views_and_case(self):
+        with Database(self.db_file) as db:
+            db.query("CREATE VIEW IF NOT EXISTS pug AS SELECT * FROM breed WHERE name = 'pug'")
+        try:
+            self.Breed.create_record(name='pug')
+            self.assertEqual(len(Table('pug', db_file=self.db_file).read_record(name='pug')), 1)
+            self.assertEqual(len(Table('BREED', db_file=self.db_file).read_record(name='pug')), 1)
+        finally:
+            with Database(self.db_file) as db:
+                db.query("DROP VIEW pug")
+
+    def test_connection_profiles(self):
+        with Database(self.db_file, profile='throughput') as db:
+            settings = db.settings()
+        self.assertEqual(settings['journal_mode'], 'wal')
+        self.assertEqual(settings['synchronous'], 1)
+        self.assertEqual(settings['busy_timeout'], 5000)
+        readonly = self.Breed.__class__(self.db_file)
+        readonly.profile = 'readonly'
+        with self.assertRaises(sqlite3.OperationalError):
+            readonly.create_record(name='pug')
+        self.assertEqual(readonly.read_record(name='pug'), [])
+        with self.assertRaises(ValueError):
+            Database(self.db_file, profile='fast')
+
+    def test_instrumentation(self):
+        events = []
+        hook = instrumentation.add_hook(post=events.append)
+        stats = StatementStats().install()
+        slow_log = SlowQueryLog(threshold=0, explain_sample=1).install()
+        try:
+            self.Breed.create_record(name='pug')
+            self.Breed.read_record(name='pug')
+            self.Breed.raw_query("SELECT * FROM breed WHERE breed_id=1")
+            self.Breed.raw_query("SELECT * FROM breed WHERE breed_id=2")
+        finally:
+            instrumentation.remove_hook(hook)
+            stats.uninstall()
+            slow_log.uninstall()
+        self.assertEqual(
+            [(e['caller'], e['rows']) for e in events],
+            [('Breed.create_record', 1), ('Breed.read_record', 1),
+             ('Breed.raw_query', 1), ('Breed.raw_query', 0)])
+        self.assertTrue(all(e['elapsed'] >= 0 and e['wait'] >= 0 for e in events))
+        self.assertEqual(stats.snapshot()['SELECT * FROM breed WHERE breed_id=?']['count'], 2)
+        self.assertTrue(any('breed_name_index' in line for line in slow_log.entries[1]['plan']))
+        self.assertEqual(instrumentation.hooks, [])
+
+    def test_index_advisor(self):
+        advisor = IndexAdvisor()
+        self.Breed.index_advisor = advisor
+        self.Dog.index_advisor = advisor
+        try:
+            gs_id = self.Breed.create_record(name='german shepherd')
+            self.Breed.read_record(name='german shepherd')
+            self.Breed.read_record(breed_id=gs_id)
+            for _ in range(3):
+                self.Dog.count_where(owner_id=1)
+            self.Dog.read_record(name='fido', owner_id=1)
+            self.Dog.read_record(breed_id=gs_id, owner_id=1)
+        finally:
+            self.Breed.index_advisor = None
+            self.Dog.index_advisor = None
+        report = advisor.report()
+        self.assertEqual(
+            [(s['table'], sorted(s['columns']), s['calls']) for s in report],
+            [('dog', ['owner_id'], 3), ('dog', ['name', 'owner_id'], 1)])
+        self.assertEqual(
+            advisor.create_index('dog', ['owner_id']),
+            'CREATE INDEX IF NOT EXISTS idx_dog_owner_id ON dog (owner_id);')
+
+    def test_index_advisor_old_plan_format(self):
+        self.assertIsNone(IndexAdvisor.columns_used(['SCAN TABLE dog'], 'dog'))
+        self.assertEqual(
+            IndexAdvisor.columns_used(
+                ['SEARCH TABLE dog USING INDEX sqlite_autoindex_dog_1 (breed_id=? AND owner_id=?)'],
+                'dog'),
+            {'breed_id', 'owner_id'})
+        self.assertEqual(
+            IndexAdvisor.columns_used(['SEARCH breed USING INTEGER PRIMARY KEY (rowid=?)'], 'breed'),
+            {'rowid'})
+        self.assertIsNone(IndexAdvisor.columns_used(['SEARCH dogs USING INDEX i (a=?)'], 'dog'))
+
+    def test_write_queue(self):
+        writes = WriteQueue(self.db_file, interval=0.05)
+        self.Breed.write_queue = writes
+        try:
+            pks = {}
+            def worker(name):
+                pks[name] = self.Breed.create_record(name=name)
+            names = [f'breed {n % 5}' for n in range(20)]
+            threads = [threading.Thread(target=worker, args=(n,)) for n in names]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(self.Breed.total_rows(), 5)
+            for name, pk in pks.items():
+                self.assertEqual(self.Breed.read_record(name=name)[0]['breed_id'], pk)
+            bad = writes.submit(self.Breed.raw_query, "INSERT INTO nope VALUES (1)")
+            good = writes.create_record(self.Breed, name='pug')
+            with self.assertRaises(sqlite3.OperationalError):
+                bad.result()
+            self.assertEqual(self.Breed.read_record(name='pug')[0]['breed_id'], good.result())
+            rows = self.Breed.read_record(name='pug')
+            self.assertEqual(self.Breed.delete_record(rows=rows), 1)
+        finally:
+            self.Breed.write_queue = None
+            writes.close()
+
+    def test_write_queue_inside_transaction(self):
+        writes = WriteQueue(self.db_file)
+        self.Breed.write_queue = writes
+        try:
+            with self.assertRaises(KeyError):
+                with Database(self.db_file) as db:
+                    db.query("INSERT INTO owner (name) VALUES ('chef bobby flay')")
+                    self.Breed.create_record(name='pug')
+                    self.assertEqual(len(self.Breed.read_record(name='pug')), 1)
+                    raise KeyError
+            self.assertEqual(self.Breed.total_rows(), 0)
+            self.assertIsNone(writes._thread)
+        finally:
+            self.Breed.write_queue = None
+            writes.close()
+
+    def test_write_queue_other_database(self):
+        writes = WriteQueue(self.db_file, profile='readonly')
+        self.Breed.write_queue = writes
+        try:
+            with self.assertRaises(ValueError):
+                self.Breed.create_record(name='pug')
+        finally:
+            self.Breed.write_queue = None
+            writes.close()
+
+    def test_connection_pool_reuses_connection(self):
+        with Database(self.db_file) as db:
+            conn = db.conn
+        with Database(self.db_file) as db:
+            self.assertIs(db.conn, conn)
+        other = []
+        def worker():
+            with Database(self.db_file) as db:
+                other.append(db.conn)
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+        self.assertIsNot(other[0], conn)
+
+    def test_connection_pool_rollback_and_close_all(self):
+        with self.assertRaises(ValueError):
+            with Database(self.db_file) as db:
+                db.query("INSERT INTO breed (name) VALUES ('poodle')")
+                raise ValueError('rollback')
+        self.assertEqual(self.Breed.total_rows(), 0)
+        close_all()
+        self.Breed.create_record(name='poodle')
+        self.assertEqual(self.Breed.total_rows(), 1)
+
 if __name__ == '__main__':
     unittest.main()